@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+"""
+    cal bench - measures how long the compiler takes on synthetic programs
+    of growing size and on the .cal files shipped in libraries/ and
+    cal_examples/.
+
+    Every case is compiled from scratch --iterations times into a throwaway
+    project. Each run is split into the compiler's phases (parse,
+    populate_item_infos, passes, compile_code_unit, export) and the gcc
+    build of the generated objects, and the median and p95 of every phase
+    are reported.
+    An extra run under tracemalloc records the front-end's peak memory.
+
+    --runtime times the programs in benchmarks/ instead. Every program is
+    built with the release profile once for each result abi and its
+    executable is run --iterations times, the median and p95 of the wall
+    clock time of a run are reported. Its results and baseline are kept
+    apart from the compiler's, in bench/runtime_results.json and
+    bench/runtime_baseline.json.
+
+    Results are written as JSON (bench/results.json by default) and compared
+    against a stored baseline (bench/baseline.json), phases that got slower
+    than --threshold percent are reported as regressions and make the
+    command exit with status 1. --save-baseline stores the new results as
+    the baseline.
+
+    flags:
+        --iterations N      runs per case (default 5)
+        --filter TEXT       only run cases whose name contains TEXT
+        --no-gcc            only time the C generation
+        --output FILE       where to write the results
+        --baseline FILE     results to compare against
+        --save-baseline     overwrite the baseline with these results
+        --threshold PCT     allowed slowdown per phase (default 10)
+        --runtime           time the benchmarks/ programs instead of the compiler
+"""
+
+import compiler as cal
+import os, sys
+import glob, io, json, contextlib, math, platform, shutil, statistics, subprocess, tempfile, time, tracemalloc
+
+BENCH_DIR = os.path.join(cal.COMPILER_DIR, "bench")
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, "results.json")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+RUNTIME_OUTPUT = os.path.join(BENCH_DIR, "runtime_results.json")
+RUNTIME_BASELINE = os.path.join(BENCH_DIR, "runtime_baseline.json")
+RUNTIME_DIR = os.path.join(cal.COMPILER_DIR, "benchmarks")
+
+PHASES = [ "parse", "populate_item_infos", "passes", "compile_code_unit", "export", "gcc" ]
+
+# phases whose median moved by less than this are treated as noise
+NOISE_FLOOR_MS = 0.5
+
+# compilation args every runtime benchmark is built with, one case per variant
+RUNTIME_VARIANTS = [
+    ("struct", { "result_abi": "struct" }),
+    ("outparam", { "result_abi": "outparam" }),
+]
+
+
+def generate_functions(count):
+    lines = [ "lib synth {" ]
+    lines.append("    fn f0(.i32 x) .i32 {")
+    lines.append("        return x + 1;")
+    lines.append("    }")
+
+    for i in range(1, count):
+        lines.append("    fn f%s(.i32 x) .i32 {" % i)
+        lines.append("        stack .i32 y = 0;")
+        lines.append("        y = f%s(x) + %s;" % (i - 1, i))
+        lines.append("        if y > 1000 {")
+        lines.append("            y = y - 1000;")
+        lines.append("        }")
+        lines.append("        return y * 2;")
+        lines.append("    }")
+
+    lines.append("    glob fn run(.i32 x) .i32 {")
+    lines.append("        return f%s(x);" % (count - 1))
+    lines.append("    }")
+    lines.append("}")
+
+    return { "synth.cal": "\n".join(lines) }, [ "synth" ], "synth.run(argc);"
+
+def generate_expression(depth, seed):
+    expression = "x"
+    operators = [ "+", "*", "-", "^", "&", "|", "<<", ">>" ]
+    for i in range(depth):
+        operator = operators[(i + seed) % len(operators)]
+        expression = "(%s %s %s)" % (expression, operator, (i % 7) + 1)
+    return expression
+
+def generate_expressions(depth):
+    lines = [ "lib synth {" ]
+    for i in range(8):
+        lines.append("    fn e%s(.i32 x) .i32 {" % i)
+        lines.append("        return %s;" % generate_expression(depth, i))
+        lines.append("    }")
+
+    lines.append("    glob fn run(.i32 x) .i32 {")
+    lines.append("        return %s;" % " + ".join("e%s(x)" % i for i in range(8)))
+    lines.append("    }")
+    lines.append("}")
+
+    return { "synth.cal": "\n".join(lines) }, [ "synth" ], "synth.run(argc);"
+
+def generate_links(count):
+    files = {}
+    for i in range(count):
+        lines = [ "lib synth%s {" % i ]
+        if i > 0:
+            lines.append("    link synth%s;" % (i - 1))
+        lines.append("    glob struct item%s {" % i)
+        lines.append("        .i32 value;")
+        lines.append("        .f32 weight;")
+        lines.append("    }")
+        # glob fn implementations keep their plain name in the object, so they have to be unique
+        lines.append("    glob fn get%s(.i32 x) .i32 {" % i)
+        if i == 0:
+            lines.append("        return x;")
+        else:
+            lines.append("        return synth%s.get%s(x) + %s;" % (i - 1, i - 1, i))
+        lines.append("    }")
+        lines.append("}")
+        files["synth%s.cal" % i] = "\n".join(lines)
+
+    links = [ "synth%s" % i for i in range(count) ]
+    return files, links, "synth%s.get%s(argc);" % (count - 1, count - 1)
+
+def generate_errcodes(count):
+    lines = [ "lib synth {" ]
+    lines.append("    errcodes SynthErrors { %s }" % ", ".join("Error%s" % i for i in range(count)))
+
+    for i in range(count):
+        lines.append("    glob struct record%s {" % i)
+        lines.append("        .i32 id;")
+        lines.append("        .i64 size;")
+        lines.append("        .ptr data;")
+        lines.append("    }")
+
+    for i in range(count):
+        lines.append("    fn check%s(.i32 x) $result{.i32} {" % i)
+        lines.append("        if x == %s {" % i)
+        lines.append("            return $err{ SynthErrors.Error%s };" % i)
+        lines.append("        }")
+        lines.append("        return $ok{ x + $struct{record%s, size} };" % i)
+        lines.append("    }")
+
+    lines.append("    glob fn run(.i32 x) .i32 {")
+    lines.append("        stack .i32 total = 0;")
+    for i in range(count):
+        lines.append("        check%s(x) ? (.i32 value) {" % i)
+        lines.append("            total += value;")
+        lines.append("        }")
+        lines.append("        catch (error) {")
+        lines.append("            total -= error;")
+        lines.append("        };")
+    lines.append("        return total;")
+    lines.append("    }")
+    lines.append("}")
+
+    return { "synth.cal": "\n".join(lines) }, [ "synth" ], "synth.run(argc);"
+
+def generate_main(links, call):
+    lines = [ "proc bench {" ]
+    for link in links:
+        lines.append("    link %s;" % link)
+    lines.append("    glob fn main(.i32 argc, .ptr_ptr argv) .i32 {")
+    lines.append("        %s" % call)
+    lines.append("        return 0;")
+    lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines)
+
+def get_synthetic_cases():
+    cases = []
+    generators = [
+        ("functions", generate_functions, [ 10, 100, 1000 ]),
+        ("expressions", generate_expressions, [ 8, 32, 128 ]),
+        ("links", generate_links, [ 2, 8, 32 ]),
+        ("errcodes", generate_errcodes, [ 10, 100, 500 ]),
+    ]
+
+    for name, generator, sizes in generators:
+        for size in sizes:
+            files, links, call = generator(size)
+            files["main.cal"] = generate_main(links, call)
+            cases.append(("%s-%s" % (name, size), files))
+    return cases
+
+def get_file_cases():
+    cases = []
+    for pattern in [ "libraries/*.cal", "cal_examples/*.cal" ]:
+        for path in sorted(glob.glob(os.path.join(cal.COMPILER_DIR, pattern))):
+            with open(path, "r") as f:
+                code = f.read()
+            name = os.path.relpath(path, cal.COMPILER_DIR)
+            cases.append((name, { "main.cal": code }))
+    return cases
+
+
+def get_runtime_cases():
+    cases = []
+    for path in sorted(glob.glob(os.path.join(RUNTIME_DIR, "*.cal"))):
+        with open(path, "r") as f:
+            code = f.read()
+        name = os.path.relpath(path, cal.COMPILER_DIR)
+        for variant, compile_args in RUNTIME_VARIANTS:
+            cases.append(("%s [%s]" % (name, variant), { "main.cal": code }, compile_args))
+    return cases
+
+
+def percentile(values, fraction):
+    # nearest rank, the p95 of a handful of runs is their maximum
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def compile_project(project_dir, files, profile_name, output, **compile_args):
+    os.makedirs(os.path.join(project_dir, "src"))
+    for file, code in files.items():
+        with open(os.path.join(project_dir, "src", file), "w") as f:
+            f.write(code)
+
+    cal.CurrentProject = cal.ProjectInfo("bench", project_dir + "/")
+    cal.Modules.clear()
+    cal.errors = 0
+    cal.current_file = os.path.join(project_dir, "src", "main.cal")
+
+    profile = cal.get_profile(profile_name, {})
+    with contextlib.redirect_stdout(output):
+        parsed = cal.parse_code(files["main.cal"])
+        if cal.errors != 0:
+            raise SyntaxError("%s parse errors" % cal.errors)
+
+        compiler = cal.Compiler()
+        compiler.compile(parsed, keep_source=False, optimization=cal.get_profile_optimization(profile), profile=profile, **compile_args)
+        cal.eliminate_dead_code(compiler.objects)
+    return compiler
+
+def get_live_objects(compiler):
+    return [ obj for obj in compiler.objects if not obj.dead ]
+
+def run_case(files, with_gcc):
+    project_dir = tempfile.mkdtemp(prefix="calbench")
+    try:
+        cal.Timings.reset()
+        cal.Timings.enabled = True
+
+        output = io.StringIO()
+        compiler = compile_project(project_dir, files, "debug", output)
+
+        timings = { phase: seconds * 1000 for phase, seconds in cal.Timings.totals.items() }
+        cal.Timings.enabled = False
+
+        if with_gcc:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                build_ok = cal.build_objects(get_live_objects(compiler), [ "-j", "1" ], None)
+            timings["gcc"] = (time.perf_counter() - start) * 1000
+
+            if not build_ok:
+                raise RuntimeError("gcc failed:\n%s" % output.getvalue()[-2000:])
+
+        return timings
+    finally:
+        cal.Timings.enabled = False
+        shutil.rmtree(project_dir, ignore_errors=True)
+
+def run_runtime_case(files, compile_args, iterations):
+    project_dir = tempfile.mkdtemp(prefix="calbench")
+    try:
+        output = io.StringIO()
+        compiler = compile_project(project_dir, files, "release", output, **compile_args)
+
+        with contextlib.redirect_stdout(output):
+            build_ok = cal.build_objects(get_live_objects(compiler), [ "-j", "1" ], None)
+        if not build_ok:
+            raise RuntimeError("gcc failed:\n%s" % output.getvalue()[-2000:])
+
+        process = [ obj for obj in compiler.objects if obj.target_type == cal.ObjectType.Process ][0]
+        executable = os.path.join(cal.CurrentProject.output_dir, process.get_name())
+
+        runs = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            result = subprocess.run([ executable ], capture_output=True)
+            runs.append((time.perf_counter() - start) * 1000)
+
+            if result.returncode != 0:
+                raise RuntimeError("%s exited with %s" % (process.get_name(), result.returncode))
+
+        return {
+            "source_lines": sum(code.count("\n") + 1 for code in files.values()),
+            "phases": { "run": { "median_ms": round(statistics.median(runs), 3), "p95_ms": round(percentile(runs, 0.95), 3) } },
+            "output": result.stdout.decode(errors="replace").strip(),
+        }
+    finally:
+        shutil.rmtree(project_dir, ignore_errors=True)
+
+def measure_peak_memory(files):
+    tracemalloc.start()
+    try:
+        run_case(files, False)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak // 1024
+
+def bench_case(name, files, iterations, with_gcc):
+    runs = []
+    for i in range(iterations):
+        runs.append(run_case(files, with_gcc))
+
+    phases = {}
+    for phase in PHASES + [ "total" ]:
+        if phase == "total":
+            values = [ sum(run.values()) for run in runs ]
+        else:
+            values = [ run.get(phase, 0.0) for run in runs ]
+
+        if phase == "gcc" and not with_gcc:
+            continue
+
+        phases[phase] = {
+            "median_ms": round(statistics.median(values), 3),
+            "p95_ms": round(percentile(values, 0.95), 3),
+        }
+
+    return {
+        "source_lines": sum(code.count("\n") + 1 for code in files.values()),
+        "phases": phases,
+        "peak_memory_kb": measure_peak_memory(files),
+    }
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    for name, case in results["cases"].items():
+        old_case = baseline.get("cases", {}).get(name)
+        if old_case == None or "error" in case or "error" in old_case:
+            continue
+
+        for phase, stats in case["phases"].items():
+            old = old_case["phases"].get(phase)
+            if old == None:
+                continue
+
+            new_ms = stats["median_ms"]
+            old_ms = old["median_ms"]
+            if new_ms - old_ms > NOISE_FLOOR_MS and new_ms > old_ms * (1 + threshold / 100):
+                regressions.append((name, phase, old_ms, new_ms))
+    return regressions
+
+def print_case(name, case):
+    if "error" in case:
+        print("%-28s skipped: %s" % (name, case["error"].splitlines()[0]))
+        return
+
+    columns = []
+    for phase in PHASES + [ "run", "total" ]:
+        if phase in case["phases"]:
+            stats = case["phases"][phase]
+            columns.append("%s %.2f/%.2f" % (phase, stats["median_ms"], stats["p95_ms"]))
+
+    if "peak_memory_kb" in case:
+        columns.append("peak %s KiB" % case["peak_memory_kb"])
+    print("%-28s %s" % (name, ", ".join(columns)))
+
+def run_benchmarks(flags):
+    iterations = max(1, int(cal.get_flag_value(flags, "--iterations", 5)))
+    case_filter = cal.get_flag_value(flags, "--filter", "")
+    with_gcc = not "--no-gcc" in flags
+    runtime = "--runtime" in flags
+    output_path = cal.get_flag_value(flags, "--output", RUNTIME_OUTPUT if runtime else DEFAULT_OUTPUT)
+    baseline_path = cal.get_flag_value(flags, "--baseline", RUNTIME_BASELINE if runtime else DEFAULT_BASELINE)
+    threshold = float(cal.get_flag_value(flags, "--threshold", 10))
+
+    cal.load_parser()
+
+    results = {
+        "compiler_version": cal.COMPILER_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "iterations": iterations,
+        "gcc": with_gcc,
+        "runtime": runtime,
+        "cases": {},
+    }
+
+    if runtime:
+        cases = get_runtime_cases()
+    else:
+        cases = [ (name, files, None) for name, files in get_synthetic_cases() + get_file_cases() ]
+
+    print("Timing %s runs per case, median/p95 in ms" % iterations)
+    for name, files, compile_args in cases:
+        if case_filter != "" and not case_filter in name:
+            continue
+
+        try:
+            if runtime:
+                case = run_runtime_case(files, compile_args, iterations)
+            else:
+                case = bench_case(name, files, iterations, with_gcc)
+        except (Exception, SyntaxError) as ex:
+            case = { "error": "%s %s" % (type(ex).__name__, ex) }
+
+        results["cases"][name] = case
+        print_case(name, case)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print("Results written to %s" % output_path)
+
+    if "--save-baseline" in flags:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=4)
+        print("Baseline saved to %s" % baseline_path)
+        return True
+
+    if not os.path.exists(baseline_path):
+        print("No baseline at %s, run with --save-baseline to store one" % baseline_path)
+        return True
+
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+
+    regressions = compare_results(results, baseline, threshold)
+    for name, phase, old_ms, new_ms in regressions:
+        print("Regression: %s %s %.2f ms -> %.2f ms (+%.0f%%)" % (name, phase, old_ms, new_ms, (new_ms / old_ms - 1) * 100 if old_ms > 0 else 100))
+
+    if len(regressions) == 0:
+        print("No regressions against %s (threshold %s%%)" % (baseline_path, threshold))
+    return len(regressions) == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmarks(sys.argv[1:]) else 1)
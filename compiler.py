@@ -5,6 +5,10 @@ import lark
 from enum import Enum
 from dataclasses import dataclass, field
 import os, sys
+import subprocess
+import concurrent.futures
+import copy, hashlib, json, math, pickle, re
+import io, contextlib, socket, time, traceback, tempfile
 
 class ObjectType(Enum):
     Undefined = 0
@@ -23,6 +27,7 @@ class OutputTarget(Enum):
     PreDecl = 2
 
 COMPILER_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPILER_VERSION = "1.0"
 
 @dataclass
 class ProjectInfo:
@@ -41,6 +46,8 @@ class ProjectInfo:
         self.flags = []
         self.required_links_for_proc_main = []
         self.dependancy_stack = []
+        self.build_cache = None
+        self.dead_objects = []
 
         self.output_dir = "%s/bin/" % project_dir
         self.lib_dir = "%s/clibs/" % project_dir
@@ -64,6 +71,293 @@ class ProjectInfo:
     
 CurrentProject: ProjectInfo = None
 
+def write_if_changed(path, text):
+    # leaving unchanged files alone keeps their mtimes stable between builds
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == text:
+                return False
+
+    with open(path, "w") as f:
+        f.write(text)
+    return True
+
+EMITTER_SPILL_SIZE = 1 << 20
+EMITTER_CHUNK_SIZE = 1 << 16
+
+"""
+    A CodeEmitter holds one section (header, pre declarations or source
+    body) of an object's generated C. Fragments are written straight into
+    a StringIO instead of being collected in a list and joined at the end.
+    Once a section grows past EMITTER_SPILL_SIZE characters it is moved to
+    a temporary file, so a very large lib does not have to be held in
+    memory until it is exported.
+
+    Readers go through chunks(), which streams the section in
+    EMITTER_CHUNK_SIZE pieces. Line based output (prototypes and wrappers)
+    uses write_line, which prefixes the emitter's current indentation.
+"""
+class CodeEmitter:
+    def __init__(self, spill_size=EMITTER_SPILL_SIZE):
+        self.buffer = io.StringIO()
+        self.spill_size = spill_size
+        self.spilled = False
+        self.size = 0
+        self.indent_level = 0
+        self.at_end = True
+
+    def write(self, *what):
+        if not self.at_end:
+            self.buffer.seek(0, io.SEEK_END)
+            self.at_end = True
+
+        for arg in what:
+            text = str(arg)
+            self.buffer.write(text)
+            self.size += len(text)
+
+        if not self.spilled and self.size > self.spill_size:
+            self.spill()
+
+    def write_line(self, *what):
+        self.write("    " * self.indent_level, *what, "\n")
+
+    def indent(self):
+        self.indent_level += 1
+
+    def dedent(self):
+        self.indent_level = max(0, self.indent_level - 1)
+
+    def spill(self):
+        spill_file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        spill_file.write(self.buffer.getvalue())
+        self.buffer = spill_file
+        self.spilled = True
+
+    def chunks(self):
+        self.buffer.flush()
+        self.buffer.seek(0)
+        self.at_end = False
+
+        while True:
+            chunk = self.buffer.read(EMITTER_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def lines(self):
+        self.buffer.flush()
+        self.buffer.seek(0)
+        self.at_end = False
+
+        while True:
+            line = self.buffer.readline()
+            if not line:
+                break
+            yield line
+
+    def getvalue(self):
+        return "".join(self.chunks())
+
+    def copy_to(self, f):
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    def update_hash(self, digest):
+        for chunk in self.chunks():
+            digest.update(chunk.encode("utf-8"))
+
+    def __len__(self):
+        return self.size
+
+"""
+    A StrippedEmitter reads a CodeEmitter with some character ranges cut
+    out. Dead code elimination uses it to leave out functions after they
+    were emitted, the emitter itself stays untouched so the object can be
+    reused by a build that does need them.
+"""
+class StrippedEmitter:
+    def __init__(self, emitter, spans):
+        self.emitter = emitter
+        self.spans = sorted(spans)
+
+    def chunks(self):
+        index = 0
+        offset = 0
+        for chunk in self.emitter.chunks():
+            end = offset + len(chunk)
+            position = offset
+            kept = []
+
+            while position < end:
+                while index < len(self.spans) and self.spans[index][1] <= position:
+                    index += 1
+                if index < len(self.spans) and self.spans[index][0] <= position:
+                    position = min(end, self.spans[index][1])
+                    continue
+
+                stop = min(end, self.spans[index][0]) if index < len(self.spans) else end
+                kept.append(chunk[position - offset:stop - offset])
+                position = stop
+
+            offset = end
+            if len(kept) > 0:
+                yield "".join(kept)
+
+    def lines(self):
+        return io.StringIO(self.getvalue())
+
+    def getvalue(self):
+        return "".join(self.chunks())
+
+    def copy_to(self, f):
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    def update_hash(self, digest):
+        for chunk in self.chunks():
+            digest.update(chunk.encode("utf-8"))
+
+def write_emitters_if_changed(path, *emitters):
+    # same as write_if_changed, but compares and writes the sections chunk by chunk
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            same = True
+            for emitter in emitters:
+                for chunk in emitter.chunks():
+                    if f.read(len(chunk)) != chunk:
+                        same = False
+                        break
+                if not same:
+                    break
+
+            if same and f.read(1) == "":
+                return False
+
+    with open(path, "w", encoding="utf-8") as f:
+        for emitter in emitters:
+            emitter.copy_to(f)
+    return True
+
+"""
+    The PhaseTimer splits the time spent generating C into the compiler's
+    phases for 'cal bench'. Phases nest (a link parses and compiles another
+    module in the middle of the linking object's codegen), the time of a
+    nested phase is only counted for the nested phase. It does nothing
+    unless enabled.
+"""
+class PhaseTimer:
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.stack = []
+        self.last = 0
+
+    def reset(self):
+        self.totals = {}
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self.switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.switch()
+            self.stack.pop()
+
+    def switch(self):
+        now = time.perf_counter()
+        if len(self.stack) > 0:
+            name = self.stack[-1]
+            self.totals[name] = self.totals.get(name, 0) + now - self.last
+        self.last = now
+
+Timings = PhaseTimer()
+
+def get_prototype(returns, name, params):
+    if len(params) == 0:
+        return "%s %s(void)" % (returns, name)
+    return "%s %s(%s)" % (returns, name, ", ".join("%s %s" % (type, pname) for type, pname in params))
+
+"""
+    Build profiles select the flags every object is compiled and linked
+    with. cflags are passed to every gcc call, ldflags only to the call
+    that links the proc. Projects can add or override profiles in a
+    cal.toml next to src/:
+
+        [build]
+        profile = "fast"        # used when no -r flag or --profile is given
+
+        [profile.fast]
+        cflags = ["-O3", "-flto", "-march=native"]
+        ldflags = ["-flto", "-Wl,--gc-sections"]
+"""
+BUILD_PROFILES = {
+    "debug": { "cflags": ["-g"], "ldflags": [] },
+    "optimized-debug": { "cflags": ["-g", "-O1"], "ldflags": [] },
+    "release": { "cflags": ["-O2", "-fopenmp-simd"], "ldflags": [] },
+    "fast": {
+        "cflags": ["-O3", "-fopenmp-simd", "-flto", "-march=native", "-fno-plt", "-ffunction-sections", "-fdata-sections"],
+        "ldflags": ["-flto", "-Wl,--gc-sections"],
+    },
+}
+
+def load_project_config(project):
+    path = os.path.join(project.project_dir, "cal.toml")
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            print("Ignoring %s, reading it needs python 3.11 or the tomli package" % path)
+            return {}
+
+    with open(path, "rb") as f:
+        try:
+            return tomllib.load(f)
+        except tomllib.TOMLDecodeError as ex:
+            print("Error in %s: %s" % (path, ex))
+            raise SyntaxError
+
+def get_profile(name, config):
+    profiles = dict(BUILD_PROFILES)
+    for profile_name, profile in config.get("profile", {}).items():
+        merged = dict(profiles.get(profile_name, { "cflags": [], "ldflags": [] }))
+        merged.update(profile)
+        profiles[profile_name] = merged
+
+    if not name in profiles:
+        print("Unknown build profile '%s', available profiles are: %s" % (name, ", ".join(profiles)))
+        raise LookupError
+
+    profile = dict(profiles[name])
+    profile["name"] = name
+
+    if "compiler" in config.get("build", {}) and not "compiler" in profile:
+        profile["compiler"] = config["build"]["compiler"]
+    return profile
+
+def get_profile_optimization(profile):
+    # the codegen only needs to know roughly how hard gcc is going to try
+    level = OptimizationLevel.Debug
+    for flag in profile["cflags"]:
+        if flag in [ "-O2", "-O3", "-Os", "-Ofast" ]:
+            return OptimizationLevel.HighOptimization
+        if flag == "-O1" or flag == "-O":
+            level = OptimizationLevel.LowOptimization
+    return level
+
+
 """
     An ObjectInfo stores all the information about whatever
     "object" we're currently compiling. An object referring to 
@@ -81,10 +375,21 @@ class ObjectInfo:
     target_exported_functions: list = field(default_factory=lambda: [])
     target_header_name: str = ""
     target_source_name: str = ""
-    target_header_body: list = field(default_factory=lambda: [])
-    target_pre_declarations: list = field(default_factory=lambda: [])
-    target_source_body: list = field(default_factory=lambda: [])
+    target_unity_name: str = ""
+    target_header_body: CodeEmitter = field(default_factory=CodeEmitter)
+    target_pre_declarations: CodeEmitter = field(default_factory=CodeEmitter)
+    target_source_body: CodeEmitter = field(default_factory=CodeEmitter)
     target_link_objects: list = field(default_factory=lambda: [])
+    target_include_objects: list = field(default_factory=lambda: [])
+    target_local_macros: list = field(default_factory=lambda: [])
+    target_local_symbols: list = field(default_factory=lambda: [])
+    target_calls: dict = field(default_factory=lambda: {})
+    target_spans: dict = field(default_factory=lambda: {})
+    target_union_users: dict = field(default_factory=lambda: {})
+    dead_functions: set = field(default_factory=set)
+    dead: bool = False
+    compile_args: dict = None
+    exported: bool = False
 
     def get_name(self):
         match(self.target_type):
@@ -104,6 +409,7 @@ class ObjectInfo:
         name = self.get_name()
         self.target_header_name = "%s.h" % name
         self.target_source_name = "%s.c" % name
+        self.target_unity_name = "%s.unity.c" % name
 
         CurrentProject.dependancy_stack.append(name)
 
@@ -116,102 +422,120 @@ class ObjectInfo:
     def export(self):
         global CurrentProject
 
-        for private in self.target_functions:
-            name = private["name"]
-            params = private["params"]
-            returns = private["returns"]
-            is_global = private["is_global"]
-
-            if not is_global:
-                self.write_pre_decl("static ")
-            self.write_pre_decl(returns, " ", name, "(")
+        if self.exported:
+            # objects reused from the module registry only need their files written again
+            self.write_files()
+            return
 
-            if len(params) == 0:
-                self.write_pre_decl("void")
-
-            i = 0
-            for type, name in params:
-                self.write_pre_decl(type, " ", name)
-
-                if i+1 < len(params):
-                    self.write_pre_decl(", ")
-                i += 1
-
-            self.write_pre_decl(");\n")
-        self.write_pre_decl("\n\n")
+        pre_decl = self.target_pre_declarations
+        for private in self.target_functions:
+            start = len(pre_decl)
+            storage = "" if private["is_global"] else "static "
+            pre_decl.write_line(storage, get_prototype(private["returns"], private["name"], private["params"]), ";")
+            self.mark_span(private["key"], "pre_decl", start)
+        pre_decl.write("\n\n")
 
         if self.target_type == ObjectType.Library:
+            if any(export["mode"] == "alias" for export in self.target_exported_functions):
+                # two steps so the unity build's renaming macros apply to the alias target
+                pre_decl.write("#define CAL_STRINGIFY(x) #x\n")
+                pre_decl.write("#define CAL_ALIAS(target) __attribute__((alias(CAL_STRINGIFY(target))))\n\n")
+
             for export in self.target_exported_functions:
                 name = export["name"]
                 params = export["params"]
                 returns = export["returns"]
-                link = export["link"]
-                link_fn = self.get_local_func(link)
 
-                self.write_header(returns, " ", name, "(")
+                start = len(self.target_header_body)
+                self.target_header_body.write_line(get_prototype(returns, name, params), ";")
+                self.target_header_body.write("\n")
+                self.mark_span(export["key"], "header", start)
 
+                if export["mode"] == "direct":
+                    # the implementation is compiled under the public name
+                    continue
 
-                if len(params) == 0:
-                    self.write_header("void")
-
-                i = 0
-                for type, pname in params:
-                    self.write_header(type, " ", pname)
+                start = len(pre_decl)
+                link_fn = self.get_local_func(export["link"])
+                if export["mode"] == "alias":
+                    pre_decl.write_line(get_prototype(returns, name, params), " CAL_ALIAS(", link_fn["name"], ");")
+                    self.mark_span(export["key"], "pre_decl", start)
+                    continue
 
-                    if i+1 < len(params):
-                        self.write_header(", ")
-                    i += 1
+                call = "%s(%s);" % (link_fn["name"], ", ".join(pname for _, pname in params))
 
-                self.write_header(");\n\n")
+                pre_decl.write_line(get_prototype(returns, name, params), " {")
+                pre_decl.indent()
+                pre_decl.write_line("return " if link_fn["returns"] != "void" else "", call)
+                pre_decl.dedent()
+                pre_decl.write_line("}")
+                pre_decl.write("\n")
+                self.mark_span(export["key"], "pre_decl", start)
 
-                self.write_pre_decl(returns, " ", name, "(")
-                i = 0
-                for type, pname in params:
-                    self.write_pre_decl(type, " ", pname)
+            self.write_header("#endif\n\n")
 
-                    if i + 1 < len(params):
-                        self.write_pre_decl(", ")
-                    i += 1
+        self.exported = True
+        self.write_files()
 
-                self.write_pre_decl(") {\n")
+    def write_files(self):
+        global CurrentProject
+        os.makedirs(CurrentProject.output_dir, exist_ok=True)
 
-                if link_fn["returns"] != "void":
-                    self.write_pre_decl("    return ")
-                self.write_pre_decl("    ", link_fn["name"], "(")
+        if self.target_type != ObjectType.Process:
+            write_emitters_if_changed(os.path.join(CurrentProject.output_dir, self.target_header_name), self.get_section("header"))
 
-                i = 0
-                for type, name in params:
-                    self.write_pre_decl(name)
+        write_emitters_if_changed(os.path.join(CurrentProject.output_dir, self.target_source_name), *self.get_source_sections())
 
-                    if i + 1 < len(params):
-                        self.write_pre_decl(", ")
-                    i += 1
+    def get_source_sections(self):
+        return (self.get_section("pre_decl"), self.get_section("source"))
 
-                self.write_pre_decl(");\n")
-                self.write_pre_decl("}\n\n")
+    def get_emitter(self, section):
+        match section:
+            case "header":
+                return self.target_header_body
+            case "pre_decl":
+                return self.target_pre_declarations
+            case _:
+                return self.target_source_body
 
+    def get_section(self, section):
+        # the section as it gets written, without the parts dead code elimination removed
+        spans = []
+        for key in self.dead_functions:
+            spans += [(start, end) for name, start, end in self.target_spans.get(key, []) if name == section]
 
-            self.write_header("#endif\n\n")
+        emitter = self.get_emitter(section)
+        return emitter if len(spans) == 0 else StrippedEmitter(emitter, spans)
 
-        if self.target_type != ObjectType.Process:
-            with open(os.path.join(CurrentProject.output_dir, self.target_header_name), "w") as f:
-                f.write("".join(self.target_header_body))
+    def mark_span(self, key, section, start):
+        # everything written to the section since start belongs to key and goes away with it
+        self.target_spans.setdefault(key, []).append((section, start, len(self.get_emitter(section))))
 
-        with open(os.path.join(CurrentProject.output_dir, self.target_source_name), "w") as f:
-            f.write("".join(self.target_pre_declarations))
-            f.write("".join(self.target_source_body))
+    def add_call(self, caller, obj, callee):
+        self.target_calls.setdefault(caller, set()).add((obj, callee))
 
     def write_header(self, *what):
-        for arg in what:
-            self.target_header_body.append(arg)
+        self.target_header_body.write(*what)
 
     def write_source(self, *what):
-        for arg in what:
-            self.target_source_body.append(arg)
+        self.target_source_body.write(*what)
 
     def write_pre_decl(self, *what):
-        for arg in what:
-            self.target_pre_declarations.append(arg)
+        self.target_pre_declarations.write(*what)
+
+    @contextlib.contextmanager
+    def redirect_source(self, emitter):
+        source = self.target_source_body
+        self.target_source_body = emitter
+        try:
+            yield
+        finally:
+            self.target_source_body = source
+
+    def define_local(self, name, value):
+        # macros that only make sense inside this object's source, a unity build #undefs them again
+        self.target_local_macros.append(name)
+        self.write_pre_decl("#define %s %s\n" % (name, value))
 
     def write(self, target, *what):
         match target:
@@ -223,14 +547,18 @@ class ObjectInfo:
                 self.write_pre_decl(*what)
 
     def compile(self, **kwargs):
+        global CurrentProject
+        # the object is only queued here, gcc gets invoked by the BuildScheduler
+        # once every object in the build has been exported
+        self.compile_args = kwargs
+        CurrentProject.dependancy_stack.pop() # should be this
+
+    def get_compile_command(self, **kwargs):
         global CurrentProject
         #kw_args = kwargs.items()
 
         compiler = "gcc"
-        object_name = self.get_name()
-
-        if self.target_type == ObjectType.Library:
-            object_name = "%s.o" % self.get_name()
+        object_name = self.get_output_name()
 
         optimizations = "-g"
         target_dir = "./bin/"
@@ -253,6 +581,19 @@ class ObjectInfo:
                 case OptimizationLevel.HighOptimization:
                     optimizations = "-O2"
 
+        if "profile" in kwargs:
+            profile = kwargs["profile"]
+            flags = list(profile["cflags"])
+
+            # the proc is compiled and linked by the same gcc call
+            if self.target_type == ObjectType.Process:
+                flags += [flag for flag in profile["ldflags"] if not flag in flags]
+
+            optimizations = " ".join(flags)
+
+            if "compiler" in profile:
+                compiler = profile["compiler"]
+
         if "keep_source" in kwargs:
             keep_source = kwargs["keep_source"]
 
@@ -270,11 +611,16 @@ class ObjectInfo:
             if not link in self.target_link_objects:
                 self.target_link_objects.append(link)
 
+        source_name = self.target_source_name
+        if "source" in kwargs:
+            source_name = kwargs["source"]
+
         links = ""
         for link in self.target_link_objects:
-            links += "%slib%scal.o " % (target_dir, link)
+            if not link in CurrentProject.dead_objects:
+                links += "%slib%scal.o " % (target_dir, link)
 
-        if self.target_type != ObjectType.Process:
+        if self.target_type != ObjectType.Process or kwargs.get("link_objects", True) == False:
             links = ""
 
         libs = ""
@@ -287,14 +633,1772 @@ class ObjectInfo:
 
         compile_only = "-c" if self.target_type == ObjectType.Library else ""
 
-        command = "%s %s -o %s%s %s%s %s %s %s" % (compiler, compile_only, target_dir, object_name, target_dir, self.target_source_name, links, libs, optimizations)
-        print(command)
-        os.system(command)
-        CurrentProject.dependancy_stack.pop() # should be this
+        return "%s %s -o %s%s %s%s %s %s %s" % (compiler, compile_only, target_dir, object_name, target_dir, source_name, links, libs, optimizations)
 
         #if not keep_source and self.target_type == ObjectType.Library:
         #    os.remove(self.target_source_name)
 
+    def get_output_name(self):
+        if self.target_type == ObjectType.Library:
+            return "%s.o" % self.get_name()
+        return self.get_name()
+
+
+"""
+    The BuildCache lives in the project's bin/.calcache/ directory and
+    lets a rebuild skip work that was already done by a previous build.
+
+    Parse trees are keyed by a hash of the .cal source, the grammar, the
+    compiler version and the build flags. Object files are keyed by a
+    fingerprint of their generated source, their gcc command and the
+    headers of the objects they include, so a library whose exported
+    header did not change does not force the libraries linking it to
+    recompile. A proc also includes the fingerprints of the .o files it
+    links in its own.
+    A forced build (-f) reuses nothing but still records what it wrote, so
+    the manifest always describes the files that are in bin/. It also
+    remembers the tree each .cal file last used per build flags, saving it
+    deletes the trees no file refers to anymore.
+"""
+class BuildCache:
+    def __init__(self, output_dir, flags_key, force=False):
+        self.cache_dir = os.path.join(output_dir, ".calcache")
+        self.tree_dir = os.path.join(self.cache_dir, "trees")
+        self.manifest_path = os.path.join(self.cache_dir, "manifest.json")
+        self.flags_key = flags_key
+        self.force = force
+        self.manifest = {}
+        self.reused_trees = 0
+        self.reused_objects = 0
+
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r") as f:
+                    self.manifest = json.load(f)
+            except (OSError, ValueError):
+                self.manifest = {}
+
+        if self.manifest.get("version") != COMPILER_VERSION:
+            self.manifest = { "version": COMPILER_VERSION, "objects": {} }
+        self.manifest.setdefault("trees", {})
+
+    def get_source_key(self, code):
+        digest = hashlib.sha256()
+        for part in (COMPILER_VERSION, get_grammar_hash(), self.flags_key, code):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def record_tree(self, source_file, source_key):
+        # one tree per file and build flags, a new version of the file replaces the old one
+        self.manifest["trees"].setdefault(self.flags_key, {})[os.path.realpath(source_file)] = source_key
+
+    def load_tree(self, source_file, code):
+        source_key = self.get_source_key(code)
+        path = os.path.join(self.tree_dir, "%s.tree" % source_key)
+        if self.force or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                tree = pickle.load(f)
+        except Exception:
+            return None
+
+        self.record_tree(source_file, source_key)
+        self.reused_trees += 1
+        return tree
+
+    def store_tree(self, source_file, code, tree):
+        os.makedirs(self.tree_dir, exist_ok=True)
+        source_key = self.get_source_key(code)
+        path = os.path.join(self.tree_dir, "%s.tree" % source_key)
+        with open(path, "wb") as f:
+            pickle.dump(tree, f)
+        self.record_tree(source_file, source_key)
+
+    def get_object_key(self, obj, command, objects, object_keys):
+        digest = hashlib.sha256()
+        digest.update(COMPILER_VERSION.encode("utf-8"))
+        digest.update(command.encode("utf-8"))
+        obj.get_section("header").update_hash(digest)
+        for section in obj.get_source_sections():
+            section.update_hash(digest)
+
+        for other in objects:
+            if other.target_type != ObjectType.Library:
+                continue
+            if other.target_name in obj.target_include_objects:
+                other.get_section("header").update_hash(digest)
+            if obj.target_type == ObjectType.Process and other.target_name in obj.target_link_objects:
+                digest.update(object_keys.get(id(other), "").encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def is_current(self, output_name, key):
+        output = os.path.join(CurrentProject.output_dir, output_name)
+        return not self.force and self.manifest["objects"].get(output_name) == key and os.path.exists(output)
+
+    def update(self, output_name, key):
+        self.manifest["objects"][output_name] = key
+
+    def invalidate(self, output_name):
+        # a failed gcc run may have left a partial or older file behind
+        self.manifest["objects"].pop(output_name, None)
+
+    def is_object_current(self, obj, key):
+        return self.is_current(obj.get_output_name(), key)
+
+    def update_object(self, obj, key):
+        self.update(obj.get_output_name(), key)
+
+    def save(self):
+        self.prune_trees()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.manifest, f, indent=4)
+
+    def prune_trees(self):
+        # trees of deleted files and of older versions of a file are never loaded again
+        live = set()
+        for trees in self.manifest["trees"].values():
+            for source_file in list(trees):
+                if not os.path.exists(source_file):
+                    del trees[source_file]
+            live.update("%s.tree" % source_key for source_key in trees.values())
+
+        if not os.path.isdir(self.tree_dir):
+            return
+
+        for entry in os.listdir(self.tree_dir):
+            if entry.endswith(".tree") and not entry in live:
+                os.remove(os.path.join(self.tree_dir, entry))
+
+
+"""
+    The BuildScheduler runs the gcc commands for every queued object.
+    The objects form a small DAG: libraries only need the headers of
+    the libraries they link (written during export), so every library
+    object can be compiled at the same time. A proc links the .o files
+    of its link objects, so it is only started once those are done.
+"""
+class BuildScheduler:
+    def __init__(self, jobs=1, cache=None, overrides=None):
+        self.jobs = max(1, jobs)
+        self.cache = cache
+        self.overrides = overrides if overrides != None else {}
+
+    def get_dependencies(self, obj, objects):
+        if obj.target_type != ObjectType.Process:
+            return []
+
+        dependencies = []
+        for other in objects:
+            if other is obj or other.target_type != ObjectType.Library:
+                continue
+            if other.target_name in obj.target_link_objects:
+                dependencies.append(other)
+        return dependencies
+
+    def run_job(self, command):
+        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        return result.returncode, result.stdout
+
+    def build(self, objects):
+        jobs = []
+        for obj in objects:
+            if obj.compile_args is None or any(obj is job for job in jobs):
+                continue
+            jobs.append(obj)
+
+        # objects reused from the module registry were exported by an earlier build,
+        # their sources may have been cleaned up since
+        for obj in jobs:
+            obj.write_files()
+
+        commands = {}
+        for obj in jobs:
+            commands[id(obj)] = obj.get_compile_command(**{ **obj.compile_args, **self.overrides })
+
+        dependencies = {}
+        for obj in jobs:
+            dependencies[id(obj)] = [id(dep) for dep in self.get_dependencies(obj, jobs)]
+
+        waiting = list(jobs)
+        running = {}
+        finished = set()
+        failed = set()
+
+        object_keys = {}
+        if self.cache != None:
+            # libraries first so a proc can fold the keys of its link objects into its own
+            for obj in sorted(jobs, key=lambda o: o.target_type == ObjectType.Process):
+                key = self.cache.get_object_key(obj, commands[id(obj)], jobs, object_keys)
+                object_keys[id(obj)] = key
+
+                if self.cache.is_object_current(obj, key):
+                    print("%s is up to date" % obj.get_output_name())
+                    self.cache.reused_objects += 1
+                    finished.add(id(obj))
+                    waiting.remove(obj)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while len(waiting) > 0 or len(running) > 0:
+                for obj in list(waiting):
+                    deps = dependencies[id(obj)]
+                    if any(dep in failed for dep in deps):
+                        print("Skipping %s, a dependency failed to compile" % obj.get_output_name())
+                        failed.add(id(obj))
+                        waiting.remove(obj)
+                    elif all(dep in finished for dep in deps):
+                        running[pool.submit(self.run_job, commands[id(obj)])] = obj
+                        waiting.remove(obj)
+
+                if len(running) == 0:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    obj = running.pop(future)
+                    returncode, output = future.result()
+
+                    print(commands[id(obj)])
+                    if output:
+                        print(output, end="")
+
+                    if returncode == 0:
+                        finished.add(id(obj))
+                        if self.cache != None:
+                            self.cache.update_object(obj, object_keys[id(obj)])
+                    else:
+                        print("Error compiling %s, gcc exited with status %s" % (obj.get_output_name(), returncode))
+                        failed.add(id(obj))
+                        if self.cache != None:
+                            self.cache.invalidate(obj.get_output_name())
+
+        if self.cache != None:
+            self.cache.save()
+
+        return len(failed) == 0
+
+
+"""
+    Dead code elimination over the whole build. Starting at the proc's main
+    the call edges every object recorded while its functions were compiled
+    are followed across objects. Functions that are never reached lose
+    their prototypes, wrappers and definitions when the sources are
+    written, error unions only they return are left out of the headers and
+    libs without a reachable function are neither compiled nor linked.
+"""
+def eliminate_dead_code(objects, enabled=True):
+    global CurrentProject
+    for obj in objects:
+        obj.dead_functions = set()
+        obj.dead = False
+    CurrentProject.dead_objects = []
+
+    if not enabled:
+        return
+
+    processes = [obj for obj in objects if obj.target_type == ObjectType.Process]
+    if len(processes) == 0:
+        return
+
+    by_name = { obj.target_name: obj for obj in objects }
+    live = set()
+    live_objects = set()
+    pending = [(proc.target_name, "main") for proc in processes]
+
+    while len(pending) > 0:
+        key = pending.pop()
+        if key in live or not key[0] in by_name:
+            continue
+        live.add(key)
+
+        obj = by_name[key[0]]
+        if not obj.target_name in live_objects:
+            live_objects.add(obj.target_name)
+            pending += obj.target_calls.get(None, [])
+        pending += obj.target_calls.get(key[1], [])
+
+    functions = 0
+    unions = 0
+    for obj in objects:
+        if obj.target_type == ObjectType.Library and not obj.target_name in live_objects:
+            obj.dead = True
+            CurrentProject.dead_objects.append(obj.target_name)
+            continue
+
+        for func in obj.target_functions:
+            if not (obj.target_name, func["key"]) in live:
+                obj.dead_functions.add(func["key"])
+        functions += len(obj.dead_functions)
+
+        for union_name, users in obj.target_union_users.items():
+            if users <= obj.dead_functions:
+                obj.dead_functions.add(union_name)
+                unions += 1
+
+    print("Dead code: removed %s functions, %s error unions and %s libs%s" % (functions, unions, len(CurrentProject.dead_objects), "" if len(CurrentProject.dead_objects) == 0 else " (%s)" % ", ".join(CurrentProject.dead_objects)))
+
+"""
+    A unity build writes every object of the build into one C file and
+    compiles it with a single gcc invocation, so gcc can inline across what
+    would otherwise be separate lib*cal.o objects. The library headers go
+    first. Each object's function implementations, static variables and
+    private structs are then renamed to <object>__<name> with macros around its
+    section. Its local #defines (error codes, error union and struct
+    aliases) are #undef'd at the end of the section so the next object can
+    define its own.
+"""
+def get_unity_source(objects):
+    libraries = [obj for obj in objects if obj.target_type == ObjectType.Library]
+    others = [obj for obj in objects if obj.target_type != ObjectType.Library]
+
+    # system headers go first so the renaming macros can never reach into them
+    includes = []
+    for obj in libraries + others:
+        for section in obj.get_source_sections():
+            for line in section.lines():
+                if line.startswith("#include <") and not line in includes:
+                    includes.append(line)
+
+    unity = CodeEmitter()
+    unity.write("/* unity build generated by cal %s */\n" % COMPILER_VERSION)
+    unity.write(*includes)
+    unity.write("\n")
+
+    for obj in libraries:
+        obj.get_section("header").copy_to(unity)
+
+    for obj in libraries + others:
+        namespace = obj.get_name()
+        # a library's glob fns are only reachable through their <lib>_<name> wrappers
+        symbols = [func["name"] for func in obj.target_functions if not func["is_global"] or (obj.target_type == ObjectType.Library and not func["public"])]
+        symbols += obj.target_local_symbols
+
+        unity.write("\n/* ---- %s ---- */\n" % namespace)
+        for symbol in symbols:
+            unity.write("#define %s %s__%s\n" % (symbol, namespace, symbol))
+
+        for section in obj.get_source_sections():
+            section.copy_to(unity)
+
+        for name in symbols + obj.target_local_macros:
+            unity.write("#undef %s\n" % name)
+
+    return unity
+
+def build_unity(objects, cache, overrides=None):
+    global CurrentProject
+    processes = [obj for obj in objects if obj.target_type == ObjectType.Process and obj.compile_args != None]
+
+    if len(processes) != 1:
+        print("A unity build needs exactly one proc, found %s" % len(processes))
+        return False
+
+    process = processes[0]
+
+    # the headers of the libraries are still included by the sources
+    for obj in objects:
+        obj.write_files()
+
+    unity_name = process.target_unity_name
+    source = get_unity_source(objects)
+    write_emitters_if_changed(os.path.join(CurrentProject.output_dir, unity_name), source)
+
+    args = dict(process.compile_args)
+    args.update(overrides if overrides != None else {})
+    args["source"] = unity_name
+    args["link_objects"] = False
+    command = process.get_compile_command(**args)
+
+    digest = hashlib.sha256((COMPILER_VERSION + command).encode("utf-8"))
+    source.update_hash(digest)
+    key = digest.hexdigest()
+    if cache != None and cache.is_current(process.get_output_name(), key):
+        print("%s is up to date" % process.get_output_name())
+        cache.reused_objects += 1
+        return True
+
+    print(command)
+    returncode, output = BuildScheduler().run_job(command)
+    if output:
+        print(output, end="")
+
+    if returncode != 0:
+        print("Error compiling %s, gcc exited with status %s" % (unity_name, returncode))
+        if cache != None:
+            cache.invalidate(process.get_output_name())
+            cache.save()
+        return False
+
+    if cache != None:
+        cache.update(process.get_output_name(), key)
+        cache.save()
+    return True
+
+
+"""
+    The ModuleRegistry remembers every .cal file that was linked, keyed by
+    its resolved path. The parsed tree, the generated objects and the tables
+    a linker needs (function infos, structs, error unions and sets) are kept
+    so that linking the same file again is a dictionary lookup instead of
+    another read, parse and codegen pass.
+"""
+@dataclass
+class ModuleInfo:
+    path: str = ""
+    mtime: float = 0
+    compilation_args: dict = None
+    tree: object = None
+    links: list = field(default_factory=lambda: [])
+    names: list = field(default_factory=lambda: [])
+    objects: list = field(default_factory=lambda: [])
+    function_infos: dict = field(default_factory=lambda: {})
+    error_sets: dict = field(default_factory=lambda: {})
+    error_structs: dict = field(default_factory=lambda: {})
+    struct_infos: dict = field(default_factory=lambda: {})
+    c_libs: list = field(default_factory=lambda: [])
+
+class ModuleRegistry:
+    def __init__(self):
+        self.modules = {}
+        self.watched_dirs = {}
+        self.parses = 0
+        self.avoided_parses = 0
+
+    def resolve(self, path):
+        return os.path.realpath(path)
+
+    def get(self, path, compilation_args=None):
+        module = self.modules.get(self.resolve(path))
+        if module != None and compilation_args != None and module.compilation_args != compilation_args:
+            return None
+        return module
+
+    def register(self, path, tree, library_compiler):
+        module = ModuleInfo(path=self.resolve(path), tree=tree)
+        module.mtime = os.path.getmtime(module.path)
+        module.compilation_args = library_compiler.compilation_args
+        module.links = list(library_compiler.imported_modules)
+
+        units = tree.children if tree.data == "start" else [tree]
+        for unit in units:
+            module.names.append(str(unit.children[0]))
+
+        module.objects = list(library_compiler.objects)
+
+        # only the exported symbols of the libs defined in this file, the same
+        # way a Compiler would see them after linking the file itself
+        prefixes = tuple("%s_" % name for name in module.names)
+
+        for key, fdef in library_compiler.function_infos.items():
+            if key.startswith(prefixes):
+                module.function_infos[key] = fdef
+
+        for key, info in library_compiler.struct_infos.items():
+            if info["is_global"] and key.startswith(prefixes):
+                module.struct_infos[key] = info
+
+        module.error_structs = dict(library_compiler.error_structs)
+        module.error_sets = dict(library_compiler.error_sets)
+        module.c_libs = list(library_compiler.c_libs)
+
+        self.modules[module.path] = module
+        return module
+
+    def reset_stats(self):
+        self.parses = 0
+        self.avoided_parses = 0
+
+    def reset_dead_code(self):
+        # the objects outlive a build in the server, what the last build found dead
+        # must not strip anything this build writes before its own elimination ran
+        for module in self.modules.values():
+            for obj in module.objects:
+                obj.dead_functions = set()
+                obj.dead = False
+
+    def clear(self):
+        self.modules = {}
+        self.watched_dirs = {}
+        self.reset_stats()
+
+    def get_watched_dirs(self, search_paths):
+        dirs = {}
+        for path in search_paths:
+            if os.path.isdir(path):
+                dirs[os.path.realpath(path)] = os.path.getmtime(path)
+        return dirs
+
+    def invalidate_stale(self, search_paths):
+        # a file added to or removed from a search path can change what a link resolves to
+        dirs = self.get_watched_dirs(search_paths)
+        if dirs != self.watched_dirs:
+            self.watched_dirs = dirs
+            count = len(self.modules)
+            self.modules = {}
+            return count
+
+        stale = set()
+        for path, module in self.modules.items():
+            if not os.path.exists(path) or os.path.getmtime(path) != module.mtime:
+                stale.add(path)
+
+        # everything linking a stale module was generated against its old tables
+        changed = len(stale) > 0
+        while changed:
+            changed = False
+            for path, module in self.modules.items():
+                if not path in stale and any(link in stale for link in module.links):
+                    stale.add(path)
+                    changed = True
+
+        for path in stale:
+            del self.modules[path]
+        return len(stale)
+
+Modules = ModuleRegistry()
+
+
+"""
+    The IR sits between the parse tree and the C that gets written out.
+    compile_code_unit lowers the body of a lib or proc into an IRModule,
+    runs the PassManager over it and only then emits C from it.
+
+    Declarations (links and errcodes) are registered while lowering, so
+    every pass can see the functions, structs and error sets the unit has
+    access to. Everything else stays in source order in IRModule.items:
+    functions as IRFunctions, the other top level statements as their parse
+    trees. Function bodies are lark trees, passes annotate them (the
+    typecheck pass stores the C type of every expression in node.meta.ty)
+    and can swap out subtrees. Parse trees are shared with the build cache
+    and the module registry, so every IRFunction gets a copy of its body
+    with its own meta (annotations of one build never reach the next one)
+    and a pass that changes a body builds new nodes instead of editing the
+    old ones.
+"""
+@dataclass
+class IRFunction:
+    name: str = ""
+    global_name: str = ""
+    params: list = field(default_factory=lambda: [])
+    return_type: str = "void"
+    is_global: bool = False
+    throws_err: bool = False
+    ok_type: str = None
+    tail_loop: bool = False
+    restrict_params: set = field(default_factory=lambda: set())
+    body: lark.Tree = None
+    node: lark.Tree = None
+    symbols: dict = field(default_factory=lambda: {})
+
+    def is_variadic(self):
+        return len(self.params) > 0 and self.params[-1][1] == "__VA_ARGS_BUF__"
+
+@dataclass
+class IRModule:
+    name: str = ""
+    object: ObjectInfo = None
+    items: list = field(default_factory=lambda: [])
+    statics: dict = field(default_factory=lambda: {})
+
+    def get_functions(self):
+        return [item for item in self.items if isinstance(item, IRFunction)]
+
+    def get_function(self, name):
+        for function in self.get_functions():
+            if function.name == name or function.global_name == name:
+                return function
+        return None
+
+    def dump(self):
+        lines = [ "module %s (%s)" % (self.name, self.object.target_type.name) ]
+        for name, c_type in self.statics.items():
+            lines.append("  static %s %s" % (c_type, name))
+
+        for item in self.items:
+            if not isinstance(item, IRFunction):
+                lines.append("  %s" % item.data)
+                continue
+
+            params = ", ".join("%s %s%s" % (c_type, "restrict " if name in item.restrict_params else "", name) for c_type, name in item.params)
+            lines.append("  %sfn %s(%s) -> %s" % ("glob " if item.is_global else "", item.name, params, item.return_type))
+            for name, c_type in item.symbols.items():
+                lines.append("    local %s %s" % (c_type, name))
+            format_ir_node(item.body, 2, lines)
+        return "\n".join(lines) + "\n"
+
+def format_ir_node(node, depth, lines):
+    if not isinstance(node, lark.Tree):
+        lines.append("%s%s" % ("  " * depth, node))
+        return
+
+    c_type = get_node_type(node)
+    lines.append("%s%s%s" % ("  " * depth, node.data, " : %s" % c_type if c_type != None else ""))
+    for child in node.children:
+        if child != None:
+            format_ir_node(child, depth + 1, lines)
+
+def get_node_type(node):
+    if isinstance(node, lark.Tree):
+        return getattr(node.meta, "ty", None)
+    return None
+
+def copy_ir_tree(node):
+    # tokens are never edited in place, only the trees and their meta need copying
+    if not isinstance(node, lark.Tree):
+        return node
+    return lark.Tree(node.data, [copy_ir_tree(child) for child in node.children], meta=copy.copy(node.meta))
+
+def get_node_position(node):
+    if isinstance(node, lark.Tree) and not node.meta.empty:
+        return node.meta.line, node.meta.column
+    return "?", "?"
+
+def get_pointee_type(c_type):
+    if c_type == None or not c_type.endswith("*"):
+        return None
+    pointee = c_type[:-1].strip()
+    return None if pointee == "void" else pointee
+
+# usual arithmetic conversions, everything below int is promoted to int
+ARITHMETIC_RANKS = { "bool": 0, "char": 0, "int8_t": 0, "int16_t": 0, "int32_t": 1, "CAL_ERR_TY": 1, "size_t": 2, "int64_t": 2, "float": 3, "double": 4 }
+
+def get_arithmetic_type(left, right):
+    if left == None or right == None:
+        return None
+
+    if left.endswith("*"):
+        return left
+    if right.endswith("*"):
+        return right
+
+    if not left in ARITHMETIC_RANKS or not right in ARITHMETIC_RANKS:
+        return None
+
+    ranked = max(left, right, key=lambda c_type: ARITHMETIC_RANKS[c_type])
+    return "int32_t" if ARITHMETIC_RANKS[ranked] <= 1 else ranked
+
+"""
+    The typecheck pass builds the symbol table of every function (params,
+    stack variables and try/catch bindings), stores the C type of every
+    expression it can work out in node.meta.ty and reports the mistakes gcc
+    would otherwise report against the generated C:
+    $ok{}/$err{} outside a function returning a $result, a $result function
+    returning a plain value, and calls to cal functions with the wrong
+    number of arguments. Names it does not know (inline C, libc) are left
+    untyped.
+"""
+class TypeCheckPass:
+    name = "typecheck"
+
+    def run(self, module, compiler):
+        self.module = module
+        self.compiler = compiler
+
+        for function in module.get_functions():
+            self.function = function
+            function.symbols = {}
+            for c_type, name in function.params:
+                function.symbols[name] = c_type
+            self.visit_block(function.body.children)
+
+    def error(self, node, message):
+        line, column = get_node_position(node)
+        print("Error on line %s, %s: %s" % (line, column, message))
+        raise SyntaxError
+
+    def visit_block(self, statements):
+        for statement in statements:
+            if isinstance(statement, lark.Tree):
+                self.visit_statement(statement)
+
+    def visit_statement(self, node):
+        match node.data:
+            case "expression":
+                self.infer(node)
+            case "stack_allocation":
+                self.function.symbols[str(node.children[1])] = self.compiler.get_c_type(str(node.children[0]))
+                self.visit_block(node.children[2:])
+            case "try_statement":
+                self.infer(node.children[0])
+                if node.children[1] != None:
+                    self.function.symbols[str(node.children[2])] = self.compiler.get_c_type(str(node.children[1]))
+                self.visit_block(node.children[3:])
+            case "catch_statement":
+                self.function.symbols[str(node.children[0])] = self.compiler.error_type_name
+                self.visit_block(node.children[1:])
+            case "return_statement":
+                self.visit_return(node)
+            case _:
+                self.visit_block(node.children)
+
+    def visit_return(self, node):
+        function = self.function
+        value = node.children[0] if len(node.children) > 0 else None
+        c_type = self.infer(value) if value != None else None
+
+        if function.throws_err:
+            if value == None:
+                self.error(node, "%s returns a $result, return $ok{} or $err{ code } instead" % function.name)
+            if c_type != None and c_type != function.return_type:
+                self.error(node, "%s returns a $result, wrap the returned value in $ok{...}" % function.name)
+
+    def lookup(self, name):
+        if name in self.function.symbols:
+            return self.function.symbols[name]
+        if name in self.module.statics:
+            return self.module.statics[name]
+
+        if "." in name and name.split(".")[0] in self.compiler.error_sets:
+            return self.compiler.error_type_name
+        return None
+
+    def infer(self, node):
+        if not isinstance(node, lark.Tree):
+            return None
+
+        c_type = None
+        children = node.children
+
+        match node.data:
+            case "expression" | "group":
+                c_type = self.infer(children[0])
+            case "value":
+                token = children[0]
+                if token.type == "NUMBER":
+                    c_type = "double" if any(c in token for c in ".eE") else "int32_t"
+                elif token.type == "STRING":
+                    c_type = "char*"
+                elif token.type == "CHAR":
+                    c_type = "char"
+            case "true" | "false":
+                c_type = "bool"
+            case "null":
+                c_type = "void*"
+            case "var":
+                c_type = self.lookup(str(children[0]))
+            case "assign" | "plus_eq" | "minus_eq" | "mul_eq" | "div_eq" | "mod_eq":
+                c_type = self.infer(children[0])
+                self.infer(children[1])
+            case "logic_equals" | "logic_notequals" | "logic_and" | "logic_or" | "logic_ge" | "logic_le" | "logic_gt" | "logic_lt":
+                self.infer(children[0])
+                self.infer(children[1])
+                c_type = "bool"
+            case "add" | "sub" | "mul" | "div" | "mod" | "bin_or" | "bin_and" | "bin_xor":
+                c_type = get_arithmetic_type(self.infer(children[0]), self.infer(children[1]))
+            case "bin_lshift" | "bin_rshift":
+                c_type = get_arithmetic_type(self.infer(children[0]), "int32_t")
+                self.infer(children[1])
+            case "neg" | "bin_not" | "post_inc" | "post_dec" | "pre_inc" | "pre_dec":
+                c_type = self.infer(children[0])
+            case "not":
+                self.infer(children[0])
+                c_type = "bool"
+            case "ref":
+                pointee = self.infer(children[0])
+                c_type = "%s*" % pointee if pointee != None else "void*"
+            case "deref_var":
+                target = self.lookup(str(children[1]))
+                c_type = self.get_deref_type(children[0], target, children[2:])
+            case "deref_func_call":
+                target = self.infer(children[1])
+                c_type = self.get_deref_type(children[0], target, children[2:])
+            case "func_call":
+                c_type = self.infer_call(node)
+            case "inline_call":
+                c_type = self.infer_call(node.children[0])
+            case "macro_sizeof" | "struct_member_offset":
+                c_type = "size_t"
+            case "macro_poolsize":
+                self.infer(children[1])
+                c_type = "size_t"
+            case "va_arg":
+                c_type = self.compiler.get_c_type(str(children[0]))
+            case "ok_result" | "err_result":
+                if not self.function.throws_err:
+                    self.error(node, "$ok{}/$err{} used in %s, which does not return a $result" % self.function.name)
+                if children[0] != None:
+                    self.infer(children[0])
+                c_type = self.function.return_type
+            case "argument_list":
+                for child in children:
+                    self.infer(child)
+
+        node.meta.ty = c_type
+        return c_type
+
+    def get_deref_type(self, cast, target, offsets):
+        for offset in offsets:
+            self.infer(offset.children[0])
+
+        if cast != None:
+            return get_pointee_type(self.compiler.get_c_type(str(cast)))
+        return get_pointee_type(target)
+
+    def infer_call(self, node):
+        callee = node.children[0]
+        arguments = []
+        if len(node.children) > 1 and node.children[1] != None:
+            arguments = [child for child in node.children[1].children[:-1]]
+
+        for argument in arguments:
+            self.infer(argument)
+
+        if callee.data != "var":
+            self.infer(callee)
+            return None
+
+        name = self.compiler.compile_name_chain(callee.children[0])
+        info = self.compiler.function_infos.get(name)
+        if info == None:
+            return None
+
+        params = info["params"]
+        variadic = len(params) > 0 and params[-1][1] == "__VA_ARGS_BUF__"
+        if not variadic and len(arguments) != len(params):
+            self.error(node, "%s takes %s arguments, %s given" % (callee.children[0], len(params), len(arguments)))
+
+        return info["return_type"]
+
+INT32_MIN = -(1 << 31)
+INT32_MAX = (1 << 31) - 1
+
+# sizes (and alignments) the constfold pass assumes, the LP64 ABI gcc uses on x86-64 and aarch64
+PRIMITIVE_SIZES = { "bool": 1, "char": 1, "int8_t": 1, "int16_t": 2, "int32_t": 4, "CAL_ERR_TY": 4, "float": 4, "int64_t": 8, "double": 8 }
+POINTER_SIZE = 8
+
+def parse_number(text):
+    try:
+        if len(text) > 1 and text.startswith("0") and text.isdigit():
+            return int(text, 8)
+        return int(text)
+    except ValueError:
+        pass
+
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def get_constant(node):
+    while isinstance(node, lark.Tree) and node.data in ("expression", "group"):
+        node = node.children[0]
+
+    if isinstance(node, lark.Token):
+        return parse_number(str(node)) if node.type == "NUMBER" else None
+
+    if not isinstance(node, lark.Tree):
+        return None
+    if node.data == "value" and node.children[0].type == "NUMBER":
+        return parse_number(str(node.children[0]))
+    if node.data == "true":
+        return 1
+    if node.data == "false":
+        return 0
+    return None
+
+# operators a $buffer{} size may combine constants with
+CONSTANT_SIZE_OPERATORS = { "add", "sub", "mul", "div", "mod", "bin_or", "bin_and", "bin_xor", "bin_lshift", "bin_rshift", "group" }
+
+def is_constant_size(node):
+    # an integer c can size an array with, folded or left to gcc as sizeof/offsetof
+    while isinstance(node, lark.Tree) and node.data == "expression":
+        node = node.children[0]
+
+    if not isinstance(node, lark.Tree):
+        return False
+    if node.data in ("macro_sizeof", "struct_member_offset"):
+        return True
+    if node.data == "macro_poolsize":
+        return is_constant_size(node.children[1])
+    if node.data in CONSTANT_SIZE_OPERATORS:
+        return all(is_constant_size(child) for child in node.children)
+    return isinstance(get_constant(node), int)
+
+def make_constant(value):
+    if isinstance(value, float):
+        node = lark.Tree("value", [lark.Token("NUMBER", repr(value))])
+        node.meta.ty = "double"
+    else:
+        node = lark.Tree("value", [lark.Token("NUMBER", str(value))])
+        node.meta.ty = "int32_t"
+    return node
+
+def truncate_division(left, right):
+    # C rounds integer division towards zero, python floors
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+def evaluate_constant(operator, left, right=None):
+    is_float = isinstance(left, float) or isinstance(right, float)
+
+    match operator:
+        case "add":
+            value = left + right
+        case "sub":
+            value = left - right
+        case "mul":
+            value = left * right
+        case "div":
+            if right == 0:
+                return None
+            value = left / right if is_float else truncate_division(left, right)
+        case "mod":
+            if is_float or right == 0:
+                return None
+            value = left - right * truncate_division(left, right)
+        case "bin_and" | "bin_or" | "bin_xor" | "bin_lshift" | "bin_rshift" | "bin_not":
+            if is_float:
+                return None
+            if operator in ("bin_lshift", "bin_rshift") and (left < 0 or right < 0 or right >= 32):
+                return None
+
+            match operator:
+                case "bin_and":
+                    value = left & right
+                case "bin_or":
+                    value = left | right
+                case "bin_xor":
+                    value = left ^ right
+                case "bin_lshift":
+                    value = left << right
+                case "bin_rshift":
+                    value = left >> right
+                case "bin_not":
+                    value = ~left
+        case "neg":
+            value = -left
+        case "not":
+            value = int(not left)
+        case "logic_equals":
+            value = int(left == right)
+        case "logic_notequals":
+            value = int(left != right)
+        case "logic_ge":
+            value = int(left >= right)
+        case "logic_le":
+            value = int(left <= right)
+        case "logic_gt":
+            value = int(left > right)
+        case "logic_lt":
+            value = int(left < right)
+        case "logic_and":
+            value = int(bool(left) and bool(right))
+        case "logic_or":
+            value = int(bool(left) or bool(right))
+        case _:
+            return None
+
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    # C does this in int, anything that would overflow is left to the C compiler
+    return value if INT32_MIN <= value <= INT32_MAX else None
+
+"""
+    The constfold pass evaluates what is already known at compile time, so
+    -g builds don't redo it at runtime: arithmetic, comparisons and bit
+    operations on literals, $sizeof{} and $struct{} offsets of types with a
+    known layout, and chains of constant static offsets in derefs
+    ([.f32_ptr this + 4 + $struct{vec2, y}] ends up with a single offset).
+    It also reaches static and stack initializers and $buffer{} sizes.
+
+    Integers are folded with C's int semantics and left alone when the
+    result would not fit an int32_t. Struct layouts assume natural
+    alignment and 8 byte pointers. Every size or offset folded from a
+    layout is also written out as a _Static_assert, so a target that lays
+    structs out differently fails to compile instead of misbehaving.
+"""
+class ConstFoldPass:
+    name = "constfold"
+
+    def run(self, module, compiler):
+        self.compiler = compiler
+        self.asserted = set()
+
+        for index, item in enumerate(module.items):
+            if isinstance(item, IRFunction):
+                item.body = self.fold(item.body)
+            elif item.data == "static_allocation":
+                module.items[index] = self.fold(item)
+
+    def fold(self, node):
+        if not isinstance(node, lark.Tree):
+            return node
+
+        children = [self.fold(child) for child in node.children]
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+
+        match node.data:
+            case "add" | "sub" | "mul" | "div" | "mod" | "bin_or" | "bin_and" | "bin_xor" | "bin_lshift" | "bin_rshift" \
+                    | "logic_equals" | "logic_notequals" | "logic_and" | "logic_or" | "logic_ge" | "logic_le" | "logic_gt" | "logic_lt":
+                left = get_constant(children[0])
+                right = get_constant(children[1])
+                if left != None and right != None:
+                    return self.replace(node, evaluate_constant(node.data, left, right))
+            case "neg" | "not" | "bin_not":
+                value = get_constant(children[0])
+                if value != None:
+                    return self.replace(node, evaluate_constant(node.data, value))
+            case "group":
+                if get_constant(children[0]) != None:
+                    return self.replace(node, get_constant(children[0]))
+            case "macro_sizeof":
+                c_type = self.compiler.get_c_type(str(children[0]))
+                layout = self.get_type_layout(c_type)
+                if layout != None:
+                    return self.replace_layout(node, "sizeof(%s)" % c_type, layout[0])
+            case "macro_poolsize":
+                c_type = self.compiler.get_c_type(str(children[0]))
+                layout = self.get_type_layout(c_type)
+                count = get_constant(children[1])
+                if layout != None and isinstance(count, int):
+                    # asserts the size the slab is computed from
+                    self.replace_layout(node, "sizeof(%s)" % c_type, layout[0])
+                    constant = make_constant(get_pool_slab_size(layout[0], count))
+                    constant.meta.ty = "size_t"
+                    return constant
+            case "struct_member_offset":
+                name = self.compiler.compile_name_chain(children[0])
+                layout = self.get_struct_layout(name)
+                if layout != None and str(children[1]) in layout[2]:
+                    return self.replace_layout(node, "offsetof(struct %s, %s)" % (name, children[1]), layout[2][str(children[1])])
+            case "deref_var" | "deref_func_call":
+                return self.fold_static_offsets(node)
+
+        return node
+
+    def replace(self, node, value):
+        if value == None:
+            return node
+        return make_constant(value)
+
+    def replace_layout(self, node, c_expression, value):
+        if not c_expression in self.asserted:
+            self.asserted.add(c_expression)
+            self.compiler.current_object.write_pre_decl("_Static_assert(%s == %s, \"cal assumes natural alignment and 8 byte pointers\");\n" % (c_expression, value))
+
+        constant = make_constant(value)
+        constant.meta.ty = "size_t"
+        return constant
+
+    def fold_static_offsets(self, node):
+        offsets = node.children[2:]
+        total = 0
+        constants = 0
+        rest = []
+
+        for offset in offsets:
+            value = get_constant(offset.children[0])
+            if isinstance(value, int):
+                total += value if offset.data == "static_plus" else -value
+                constants += 1
+            else:
+                rest.append(offset)
+
+        if constants < 2:
+            return node
+
+        if total > 0:
+            rest.append(lark.Tree("static_plus", [lark.Token("NUMBER", str(total))]))
+        elif total < 0:
+            rest.append(lark.Tree("static_minus", [lark.Token("NUMBER", str(-total))]))
+
+        return lark.Tree(node.data, node.children[:2] + rest, meta=node.meta)
+
+    def get_type_layout(self, c_type):
+        if c_type in PRIMITIVE_SIZES:
+            return PRIMITIVE_SIZES[c_type], PRIMITIVE_SIZES[c_type]
+        if c_type != None and c_type.endswith("*"):
+            return POINTER_SIZE, POINTER_SIZE
+        if c_type != None and c_type.startswith("struct "):
+            layout = self.get_struct_layout(c_type[7:].strip())
+            return layout[:2] if layout != None else None
+        return None
+
+    def get_struct_layout(self, name):
+        # inside a lib its own glob structs are also reachable by their short name
+        info = self.compiler.struct_infos.get(name)
+        if info == None:
+            info = self.compiler.struct_infos.get("%s_%s" % (self.compiler.current_object.target_name, name))
+        if info == None:
+            return None
+
+        offset = 0
+        alignment = 1
+        offsets = {}
+        for c_type, member in info["members"]:
+            layout = self.get_type_layout(c_type)
+            if layout == None:
+                return None
+
+            size, member_alignment = layout
+            offset = (offset + member_alignment - 1) // member_alignment * member_alignment
+            offsets[member] = offset
+            offset += size
+            alignment = max(alignment, member_alignment)
+
+        size = (offset + alignment - 1) // alignment * alignment
+        return size, alignment, offsets
+
+# a loop reuses the frame, so nothing may point into the frame of the call it replaces
+# and the defers of every level would run as the loop goes round, not on the way back out
+TAIL_CALL_BLOCKERS = { "ref", "raw_c_statement", "va_arg", "macro_buffer_typed_alloc", "macro_buffer_struct_alloc", "macro_buffer_bytes_alloc", "defer_statement" }
+
+"""
+    The TailCallPass turns self recursive tail calls into jumps back to the
+    start of the function, both `return f(...)` and a call that is the last
+    statement of a void function (or of the last if/else at its end).
+    Functions with defers are left alone, a loop would run each level's
+    defers before the rest of the recursion instead of after it.
+"""
+class TailCallPass:
+    name = "tailcall"
+
+    def run(self, module, compiler):
+        self.compiler = compiler
+
+        for function in module.get_functions():
+            if function.is_variadic():
+                continue
+
+            # one walk decides, only a fn that calls itself is worth rewriting
+            self.function = function
+            calls_itself = False
+            for node in function.body.iter_subtrees():
+                if node.data in TAIL_CALL_BLOCKERS:
+                    calls_itself = False
+                    break
+                if node.data == "func_call" and not calls_itself:
+                    calls_itself = self.is_self_call(node)
+            if not calls_itself:
+                continue
+
+            self.found = 0
+            body = self.rewrite_returns(function.body)
+
+            if function.return_type == "void":
+                body = lark.Tree(body.data, self.rewrite_trailing(body.children), meta=body.meta)
+
+            if self.found > 0:
+                function.body = body
+                function.tail_loop = True
+
+    def is_self_call(self, node):
+        if isinstance(node, lark.Tree) and node.data == "expression":
+            node = node.children[0]
+        if not isinstance(node, lark.Tree) or node.data != "func_call" or node.children[0].data != "var":
+            return False
+
+        arguments = node.children[1].children[:-1] if len(node.children) > 1 else []
+        name = self.compiler.compile_name_chain(node.children[0].children[0])
+        return name in (self.function.name, self.function.global_name) and len(arguments) == len(self.function.params)
+
+    def make_tail_call(self, node, value):
+        self.found += 1
+        call = value.children[0] if value.data == "expression" else value
+        return lark.Tree("tail_call", [call], meta=node.meta)
+
+    def rewrite_returns(self, node):
+        if not isinstance(node, lark.Tree):
+            return node
+
+        if node.data == "return_statement" and len(node.children) > 0 and self.is_self_call(node.children[0]):
+            return self.make_tail_call(node, node.children[0])
+
+        children = [self.rewrite_returns(child) for child in node.children]
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+        return node
+
+    def rewrite_trailing(self, statements):
+        statements = list(statements)
+        if len(statements) == 0:
+            return statements
+
+        last = statements[-1]
+        if not isinstance(last, lark.Tree):
+            return statements
+
+        if self.is_self_call(last):
+            statements[-1] = self.make_tail_call(last, last)
+        elif last.data == "if_statement":
+            statements[-1] = self.rewrite_if(last)
+        return statements
+
+    def rewrite_if(self, node):
+        # the statements of the taken branch run last, so each branch's last statement is a tail position
+        body = []
+        branches = []
+        for child in node.children[1:]:
+            if isinstance(child, lark.Tree) and child.data in ("else_if", "else"):
+                branches.append(child)
+            elif len(branches) == 0:
+                body.append(child)
+
+        children = [node.children[0]] + self.rewrite_trailing(body)
+        for branch in branches:
+            if branch.data == "else_if":
+                children.append(lark.Tree("else_if", [self.rewrite_if(branch.children[0])], meta=branch.meta))
+            else:
+                children.append(lark.Tree("else", self.rewrite_trailing(branch.children), meta=branch.meta))
+        return lark.Tree(node.data, children, meta=node.meta)
+
+# bigger bodies stay calls, loops count extra because every copy repeats them
+INLINE_MAX_COST = 40
+INLINE_LOOP_COST = 10
+INLINE_BLOCKERS = { "raw_c_statement", "va_arg", "inline_call", "macro_buffer_typed_alloc", "macro_buffer_struct_alloc", "macro_buffer_bytes_alloc", "defer_statement" }
+
+"""
+    The InlinePass replaces calls to small, non recursive functions with an
+    inline_call node holding the call, the renamed parameters and a copy of
+    the callee's body. Locals of the copy get a unique suffix, names of
+    another lib are qualified so they resolve from the calling object and
+    bodies that use something the caller cannot see (raw c, statics or
+    private functions of another lib) are left alone. Bodies with defers
+    stay calls so their defers run in the order the fn's own lowering gives.
+    Only the original bodies are copied, so inlining is one level deep.
+"""
+class InlinePass:
+    name = "inline"
+
+    def run(self, module, compiler):
+        self.module = module
+        self.compiler = compiler
+        self.candidates = {}
+        self.inlined = {}
+        self.counter = 0
+
+        for function in module.get_functions():
+            function.body = self.visit(function.body)
+
+        if len(self.inlined) > 0:
+            print("Inlined into %s: %s" % (module.name, ", ".join("%s (%s)" % (name, count) for name, count in self.inlined.items())))
+
+    def visit(self, node):
+        if not isinstance(node, lark.Tree):
+            return node
+
+        children = [self.visit(child) for child in node.children]
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+
+        if node.data == "func_call" and isinstance(node.children[0], lark.Tree) and node.children[0].data == "var":
+            return self.inline_call(node)
+        return node
+
+    def inline_call(self, node):
+        name = str(node.children[0].children[0])
+        candidate = self.get_candidate(name)
+        arguments = node.children[1].children[:-1] if len(node.children) > 1 else []
+
+        if candidate == None or len(arguments) != len(candidate["params"]):
+            return node
+
+        self.counter += 1
+        suffix = "_i%s" % self.counter
+        body = self.copy(candidate["body"], candidate, suffix)
+        params = lark.Tree("inline_params", [lark.Token("NAME", param + suffix) for _, param in candidate["params"]])
+
+        self.inlined[name] = self.inlined.get(name, 0) + 1
+        return lark.Tree("inline_call", [node, params, body], meta=node.meta)
+
+    def get_candidate(self, name):
+        if name in self.candidates:
+            return self.candidates[name]
+        self.candidates[name] = None
+
+        info = self.compiler.function_infos.get(self.compiler.compile_name_chain(name))
+        if info == None or info["body_node"] == None:
+            return None
+
+        params = info["params"]
+        if len(params) > 0 and params[-1][1] == "__VA_ARGS_BUF__":
+            return None
+
+        body = info["body_node"]
+        if self.get_cost(body) > INLINE_MAX_COST:
+            return None
+
+        candidate = {
+            "info": info,
+            "params": params,
+            "body": body,
+            "object": info["object"],
+            "is_local": info["object"] == self.compiler.current_object.target_name,
+            "locals": self.get_locals(params, body),
+        }
+
+        # a dry run finds the names the caller could not resolve
+        self.blocked = False
+        self.copy(body, candidate, "")
+        if self.blocked:
+            return None
+
+        self.candidates[name] = candidate
+        return candidate
+
+    def get_cost(self, body):
+        cost = 0
+        for node in body.iter_subtrees():
+            cost += 1
+            if node.data in ("while_statement", "do_while_statement", "for_statement"):
+                cost += INLINE_LOOP_COST
+        return cost
+
+    def get_locals(self, params, body):
+        names = set(name for _, name in params)
+        for node in body.iter_subtrees():
+            if node.data == "stack_allocation":
+                names.add(str(node.children[1]))
+            elif node.data == "try_statement" and node.children[2] != None:
+                names.add(str(node.children[2]))
+            elif node.data == "catch_statement":
+                names.add(str(node.children[0]))
+        return names
+
+    def copy(self, node, candidate, suffix):
+        if node.data in INLINE_BLOCKERS:
+            self.blocked = True
+
+        children = []
+        for index, child in enumerate(node.children):
+            if isinstance(child, lark.Tree):
+                child = self.copy(child, candidate, suffix)
+            elif isinstance(child, lark.Token):
+                child = self.copy_token(node, index, child, candidate, suffix)
+            children.append(child)
+
+        if node.data == "func_call" and isinstance(children[0], lark.Tree) and children[0].data == "var":
+            callee = self.compiler.compile_name_chain(children[0].children[0])
+            if callee in (candidate["info"]["name"], candidate["info"]["global_name"]):
+                self.blocked = True
+
+        # the body belongs to the callee's parse tree, the copy gets its own annotations
+        return lark.Tree(node.data, children, meta=copy.copy(node.meta))
+
+    def copy_token(self, parent, index, token, candidate, suffix):
+        if token.type == "TYPE":
+            if str(token).startswith("$struct{"):
+                return lark.Token("TYPE", "$struct{%s}" % self.qualify_struct(str(token)[8:-1].strip(), candidate))
+            return token
+
+        if not token.type in ("NAME", "NAME_CHAIN"):
+            return token
+
+        if parent.data == "struct_member_offset":
+            return token if index == 1 else lark.Token(token.type, self.qualify_struct(str(token), candidate))
+
+        name = str(token)
+        if name in candidate["locals"]:
+            return lark.Token(token.type, name + suffix)
+        return lark.Token(token.type, self.qualify_name(name, candidate))
+
+    def is_visible(self, name):
+        head = name.split(".")[0]
+        current = self.compiler.current_object
+        return head == current.target_name or head in current.target_include_objects
+
+    def qualify_name(self, name, candidate):
+        if candidate["is_local"]:
+            return name
+
+        owner = candidate["object"]
+        head = name.split(".")[0]
+        error_sets = self.compiler.error_sets
+
+        if "." in name:
+            if head in error_sets and error_sets[head]["object"] == owner:
+                return "%s.%s" % (owner, name)
+            if self.is_visible(name):
+                return name
+        elif "%s_%s" % (owner, name) in self.compiler.function_infos:
+            return "%s.%s" % (owner, name)
+
+        self.blocked = True
+        return name
+
+    def qualify_struct(self, name, candidate):
+        if candidate["is_local"]:
+            return name
+
+        if "." in name:
+            if not self.is_visible(name):
+                self.blocked = True
+            return name
+
+        visible_name = "%s_%s" % (candidate["object"], name)
+        if not visible_name in self.compiler.struct_infos or not self.compiler.struct_infos[visible_name]["is_global"]:
+            self.blocked = True
+        return "%s.%s" % (candidate["object"], name)
+
+# the statements the pass rewrites, a fn without any is skipped
+LOOP_STATEMENTS = ( "while_statement", "do_while_statement", "for_statement" )
+# writes and declarations that make a name loop variant
+LOOP_WRITES = { "assign", "plus_eq", "minus_eq", "mul_eq", "div_eq", "mod_eq", "post_inc", "post_dec", "pre_inc", "pre_dec" }
+# raw c can write any local, loops containing it are left alone
+LOOP_BLOCKERS = { "raw_c_statement", "va_arg" }
+# pure operators that cannot trap, so evaluating them once before a loop that might not run is safe
+LOOP_INVARIANT_OPERATORS = { "add", "sub", "mul", "bin_or", "bin_and", "bin_xor", "bin_lshift", "bin_rshift", "neg", "bin_not", "not", "group",
+    "logic_equals", "logic_notequals", "logic_and", "logic_or", "logic_ge", "logic_le", "logic_gt", "logic_lt" }
+# anything that can reach memory the fn does not see by name
+RESTRICT_BLOCKERS = { "func_call", "inline_call", "raw_c_statement", "ref", "va_arg" }
+
+"""
+    The LoopPass does the loop work gcc only does at -O1 and up, so -g builds
+    get it as well. Expressions of a loop that only read locals the loop never
+    writes are computed once into a _LOOP_INV_n temporary in front of it.
+    In a for loop stepping an index by a constant, [ptr + index] derefs read
+    through a _LOOP_PTR_n cursor that the step moves with the index. The
+    rewritten loop goes into a loop_block with its temporaries declared
+    first, $simd loops keep their indexed derefs for the vectorizer. Pointer params are marked restrict when the fn calls nothing,
+    takes no addresses and either never stores through a pointer or only
+    dereferences that one param.
+"""
+class LoopPass:
+    name = "loops"
+
+    def run(self, module, compiler):
+        self.module = module
+        self.compiler = compiler
+        self.counter = 0
+        self.hoisted = 0
+        self.reduced = 0
+        self.in_simd = False
+        restricted = 0
+
+        for function in module.get_functions():
+            self.function = function
+            function.restrict_params = function.restrict_params | self.get_restrict_params(function)
+            restricted += len(function.restrict_params)
+
+            # a body without loops has nothing to hoist or reduce
+            if not any(node.data in LOOP_STATEMENTS for node in function.body.iter_subtrees()):
+                continue
+            self.referenced = self.get_referenced_names(function.body)
+            function.body = self.visit(function.body)
+
+        if self.hoisted + self.reduced + restricted > 0:
+            print("Loops in %s: hoisted %s invariants, reduced %s derefs, %s restrict params" % (module.name, self.hoisted, self.reduced, restricted))
+
+    def visit(self, node):
+        if not isinstance(node, lark.Tree) or node.data == "inline_call":
+            return node
+
+        # vectorizers want $simd loops indexed, not stepping cursors
+        in_simd = self.in_simd
+        self.in_simd = in_simd or node.data == "simd_loop"
+        children = [self.visit(child) for child in node.children]
+        self.in_simd = in_simd
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+
+        if not node.data in LOOP_STATEMENTS:
+            return node
+        if any(sub.data in LOOP_BLOCKERS for sub in node.iter_subtrees()):
+            return node
+
+        temps = []
+        if node.data == "for_statement" and not self.in_simd:
+            node = self.reduce_strength(node, temps)
+        node = self.hoist_invariants(node, temps)
+
+        if len(temps) == 0:
+            return node
+        return lark.Tree("loop_block", temps + [node], meta=node.meta)
+
+    def get_referenced_names(self, body):
+        # locals whose address is taken can change behind any store or call
+        names = set()
+        for node in body.iter_subtrees():
+            if node.data == "ref":
+                names.update(str(sub.children[0]) for sub in node.iter_subtrees() if sub.data == "var")
+        return names
+
+    def get_written_names(self, nodes):
+        names = set()
+        for root in nodes:
+            if not isinstance(root, lark.Tree):
+                continue
+            for node in root.iter_subtrees():
+                match node.data:
+                    case "assign" | "plus_eq" | "minus_eq" | "mul_eq" | "div_eq" | "mod_eq" | "post_inc" | "post_dec" | "pre_inc" | "pre_dec":
+                        if isinstance(node.children[0], lark.Tree):
+                            names.update(str(sub.children[0]) for sub in node.children[0].iter_subtrees() if sub.data == "var")
+                    case "stack_allocation" | "loop_temp":
+                        names.add(str(node.children[1]))
+                    case "try_statement":
+                        if node.children[1] != None:
+                            names.add(str(node.children[2]))
+                    case "catch_statement":
+                        names.add(str(node.children[0]))
+                    case "inline_params":
+                        names.update(str(name) for name in node.children)
+                    case "tail_call":
+                        names.update(name for _, name in self.function.params)
+        return names
+
+    def make_temp(self, prefix, c_type, value, temps):
+        name = "_%s_%s" % (prefix, self.counter)
+        self.counter += 1
+        temps.append(lark.Tree("loop_temp", [lark.Token("TYPE", c_type), lark.Token("NAME", name), value]))
+
+        var = lark.Tree("var", [lark.Token("NAME_CHAIN", name)])
+        var.meta.ty = c_type
+        return var
+
+    def get_loop_step(self, step):
+        # (index, operator, amount) of `i++`, `i--`, `i += N` and `i -= N` steps
+        if step == None:
+            return None
+        node = step.children[0] if step.data == "expression" else step
+        target = node.children[0] if len(node.children) > 0 else None
+        if not isinstance(target, lark.Tree) or target.data != "var":
+            return None
+
+        match node.data:
+            case "post_inc" | "pre_inc":
+                return str(target.children[0]), "plus_eq", "1"
+            case "post_dec" | "pre_dec":
+                return str(target.children[0]), "minus_eq", "1"
+            case "plus_eq" | "minus_eq":
+                amount = get_constant(node.children[1])
+                if isinstance(amount, int) and not isinstance(amount, bool):
+                    return str(target.children[0]), node.data, str(amount)
+        return None
+
+    def reduce_strength(self, node, temps):
+        step = self.get_loop_step(node.children[2])
+        if step == None:
+            return node
+
+        index, operator, amount = step
+        index_type = self.function.symbols.get(index)
+        if not index_type in ARITHMETIC_RANKS or index_type in ("float", "double") or index in self.referenced:
+            return node
+
+        # the index may only change in the step, the base pointers not at all
+        loop = [node.children[1]] + node.children[3:-1]
+        if index in self.get_written_names(loop):
+            return node
+        written = self.get_written_names(loop + [node.children[2]])
+
+        self.cursors = {}
+        self.reduce_index = index
+        self.reduce_written = written
+        self.reduce_temps = temps
+        children = [self.reduce_derefs(child) for child in loop]
+        if len(self.cursors) == 0:
+            return node
+
+        inits = [node.children[0]] if node.children[0] != None else []
+        steps = [node.children[2]]
+        for base, cursor in self.cursors.items():
+            base_var = lark.Tree("var", [lark.Token("NAME_CHAIN", base)])
+            index_var = lark.Tree("var", [lark.Token("NAME_CHAIN", index)])
+            inits.append(lark.Tree("assign", [cursor, lark.Tree("add", [base_var, index_var])]))
+            steps.append(lark.Tree(operator, [cursor, make_constant(int(amount))]))
+
+        init = lark.Tree("expression", [lark.Tree("comma", inits)])
+        step = lark.Tree("expression", [lark.Tree("comma", steps)])
+        return lark.Tree(node.data, [init, children[0], step] + children[1:] + [node.children[-1]], meta=node.meta)
+
+    def reduce_derefs(self, node):
+        if not isinstance(node, lark.Tree) or node.data in ("inline_call", "defer_statement"):
+            return node
+
+        children = [self.reduce_derefs(child) for child in node.children]
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+
+        if node.data != "deref_var":
+            return node
+
+        base = str(node.children[1])
+        base_type = self.function.symbols.get(base)
+        if base_type == None or not base_type.endswith("*") or base in self.reduce_written or base in self.referenced:
+            return node
+
+        offsets = node.children[2:]
+        uses = [offset for offset in offsets if isinstance(offset.children[0], lark.Token) and str(offset.children[0]) == self.reduce_index]
+        if len(uses) != 1 or uses[0].data != "static_plus":
+            return node
+
+        if not base in self.cursors:
+            self.cursors[base] = self.make_temp("LOOP_PTR", base_type, None, self.reduce_temps)
+        self.reduced += 1
+
+        rest = [offset for offset in offsets if not offset is uses[0]]
+        return lark.Tree("deref_var", [node.children[0], lark.Token("NAME_CHAIN", str(self.cursors[base].children[0]))] + rest, meta=node.meta)
+
+    def hoist_invariants(self, node, temps):
+        self.invariant_written = self.get_written_names([node])
+        self.invariants = {}
+        self.invariant_temps = temps
+
+        # the for init runs once already and a loop's else runs after it
+        children = list(node.children)
+        first = 1 if node.data == "for_statement" else 0
+        for i in range(first, len(children)):
+            child = children[i]
+            if isinstance(child, lark.Tree) and child.data != "else":
+                children[i] = self.hoist(child)
+
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+        return node
+
+    def hoist(self, node):
+        if not isinstance(node, lark.Tree) or node.data in ("inline_call", "defer_statement"):
+            return node
+
+        if node.data == "loop_block":
+            # temporaries of an inner loop that are invariant here as well move out whole
+            children = []
+            for child in node.children:
+                if child.data == "loop_temp" and child.children[2] != None and self.is_invariant(child.children[2]):
+                    self.invariant_temps.append(child)
+                else:
+                    children.append(self.hoist(child))
+            if len(children) == 1:
+                return children[0]
+            return lark.Tree(node.data, children, meta=node.meta)
+
+        c_type = get_node_type(node)
+        if node.data in LOOP_INVARIANT_OPERATORS and node.data != "group" and (c_type in ARITHMETIC_RANKS or (c_type != None and c_type.endswith("*"))):
+            if self.is_invariant(node) and any(sub.data == "var" for sub in node.iter_subtrees()):
+                if not node in self.invariants:
+                    self.invariants[node] = self.make_temp("LOOP_INV", c_type, node, self.invariant_temps)
+                    self.hoisted += 1
+                return self.invariants[node]
+
+        children = [self.hoist(child) for child in node.children]
+        if any(new is not old for new, old in zip(children, node.children)):
+            node = lark.Tree(node.data, children, meta=node.meta)
+        return node
+
+    def is_invariant(self, node):
+        match node.data:
+            case "value":
+                return node.children[0].type in ("NUMBER", "CHAR")
+            case "true" | "false" | "macro_sizeof" | "struct_member_offset":
+                return True
+            case "var":
+                name = str(node.children[0])
+                return name in self.function.symbols and not name in self.invariant_written and not name in self.referenced
+        if not node.data in LOOP_INVARIANT_OPERATORS:
+            return False
+        return all(isinstance(child, lark.Tree) and self.is_invariant(child) for child in node.children)
+
+    def get_restrict_params(self, function):
+        pointers = set(name for c_type, name in function.params if c_type.endswith("*"))
+        if len(pointers) == 0 or function.is_variadic():
+            return set()
+
+        stores = False
+        bases = set()
+        statics = False
+        for node in function.body.iter_subtrees():
+            if node.data in RESTRICT_BLOCKERS:
+                return set()
+            if node.data in LOOP_WRITES and isinstance(node.children[0], lark.Tree):
+                target = node.children[0]
+                if target.data in ("deref_var", "deref_func_call"):
+                    stores = True
+                elif node.data == "assign" and target.data == "var":
+                    # p = q makes p point anywhere, p += n stays inside the same object
+                    pointers.discard(str(target.children[0]))
+            if node.data == "deref_var":
+                bases.add(str(node.children[1]))
+            if node.data == "var" and not str(node.children[0]) in function.symbols and str(node.children[0]) in self.module.statics:
+                statics = True
+
+        if not stores:
+            return pointers
+        # a stored to object is only ever reached through the one param
+        if len(bases) == 1 and bases <= pointers and not statics:
+            return bases
+        return set()
+
+PASSES = {
+    "typecheck": TypeCheckPass,
+    "constfold": ConstFoldPass,
+    "inline": InlinePass,
+    "tailcall": TailCallPass,
+    "loops": LoopPass,
+}
+
+# the passes every optimization level runs when no --passes list is given
+PASS_PIPELINES = {
+    OptimizationLevel.Debug: [ "typecheck", "tailcall", "constfold", "loops" ],
+    OptimizationLevel.LowOptimization: [ "typecheck", "tailcall", "inline", "constfold", "loops" ],
+    OptimizationLevel.HighOptimization: [ "typecheck", "tailcall", "inline", "constfold", "loops" ],
+}
+
+def get_pass_names(flags, config, optimization):
+    names = get_flag_value(flags, "--passes", None)
+    if names == None:
+        names = config.get("build", {}).get("passes", None)
+    if names == None:
+        return list(PASS_PIPELINES[optimization])
+
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(",") if name.strip() != ""]
+
+    for name in names:
+        if not name in PASSES:
+            print("Unknown pass '%s', available passes are: %s" % (name, ", ".join(PASSES)))
+            raise LookupError
+    return names
+
+"""
+    The PassManager runs the configured passes over an IRModule in order.
+    The pass list comes from the compilation args (--passes, [build] passes
+    in cal.toml) and falls back to the pipeline of the optimization level.
+"""
+class PassManager:
+    def __init__(self, compilation_args):
+        names = compilation_args.get("passes", None)
+        if names == None:
+            names = PASS_PIPELINES[compilation_args.get("optimization", OptimizationLevel.Debug)]
+        self.passes = [PASSES[name]() for name in names]
+
+    def run(self, module, compiler):
+        for ir_pass in self.passes:
+            with Timings.phase("passes"):
+                ir_pass.run(module, compiler)
+
+
+# how $result fns return: the result union by value, or the error code with the
+# ok value written through a trailing out pointer
+RESULT_ABIS = ["struct", "outparam"]
+
+# alignment of typed $buffer{} arrays, one avx register
+SIMD_ALIGNMENT = 32
+
+# size classes and slab header of libraries/pool.cal, $poolsize{} rounds an object
+# up to its class the same way pool.Alloc does
+POOL_SIZE_CLASSES = [16, 32, 48, 64, 96, 128, 192, 256]
+POOL_SLAB_HEADER = 16
+
+def get_pool_slab_size(size, count):
+    size_class = next((size_class for size_class in POOL_SIZE_CLASSES if size <= size_class), size)
+    return POOL_SLAB_HEADER + count * size_class
+
+# how defers are lowered: copied in front of every return, or written once as a
+# chain of labels at the end of the fn that every return jumps into. either way a
+# return's value is computed before the defers run
+DEFER_LOWERINGS = ["copy", "cleanup"]
+
+# how a lib's glob fns are exported: through a <lib>_<name> wrapper around the
+# static implementation, by compiling the implementation under the public name,
+# as an alias of the implementation, or as a static inline definition in the header
+EXPORT_MODES = ["wrapper", "direct", "alias", "inline"]
+HEADER_INLINE_MAX_NODES = 80
+HEADER_INLINE_BLOCKERS = { "func_call", "deref_func_call", "try_statement", "raw_c_statement", "macro_buffer_typed_alloc", "macro_buffer_struct_alloc", "macro_buffer_bytes_alloc", "macro_sizeof", "macro_poolsize", "struct_member_offset" }
 
 def sort_objects(item):
     if item.data == "begin_lib":
@@ -321,22 +2425,34 @@ class Compiler:
         self.error_type_name = "CAL_ERR_TY"
         self.error_structs = {}
         self.current_error_struct_type = None
+        self.current_ok_type = None
+        self.result_out_target = None
+        self.result_out_name = "_RESULT_OUT"
+        self.inline_exit = None
+        self.defer_exit = None
+        self.loop_pragma = None
+        self.current_function = None
+        self.current_return_type = None
         self.function_infos = {}
         self.struct_infos = {}
         self.error_index_counter = 0
         self.deferred_statements = []
         self.objects = []
         self.c_libs = []
+        self.imported_modules = []
+        self.export_mode = None
+        self.header_inline = False
 
     def compile(self, tree, **kw_args):
         self.compilation_args = kw_args
 
-        if tree.data == "start":
-            ls = sorted(tree.children, key=sort_objects)
-            for item in ls:
-                self.populate_item_infos(item)
-        else:
-            self.populate_item_infos(tree)
+        with Timings.phase("populate_item_infos"):
+            if tree.data == "start":
+                ls = sorted(tree.children, key=sort_objects)
+                for item in ls:
+                    self.populate_item_infos(item)
+            else:
+                self.populate_item_infos(tree)
 
         if tree.data == "begin_lib":
             self.compile_lib(tree)
@@ -347,7 +2463,7 @@ class Compiler:
         elif tree.data == "start":
             ls = sorted(tree.children, key=sort_objects)
             for item in ls:
-                self.compile(item)
+                self.compile(item, **self.compilation_args)
 
     def populate_item_infos(self, code_obj):
         if code_obj.data == "begin_lib":
@@ -378,11 +2494,21 @@ class Compiler:
 
         for item in code_obj.children[1].children:
             try:
-                if item.data == "function":
+                if item.data == "function" and not self.uses_linked_struct(item):
                     self.get_function_info(item)
             except:
                 continue
     
+    def uses_linked_struct(self, func_node):
+        cursor = 1 if func_node.children[0] == "glob" else 0
+        tokens = []
+        for node in func_node.children[cursor + 1:cursor + 3]:
+            if isinstance(node, lark.Tree):
+                tokens.extend(node.scan_values(lambda value: isinstance(value, lark.Token)))
+            elif node != None:
+                tokens.append(node)
+        return any(re.match(r"\$(struct|result)\{\s*\w+\.", str(token)) for token in tokens)
+
     def get_struct_info(self, struct_node):
         is_global = struct_node.children[0] != None and str(struct_node.children[0]) == "glob"
         name = str(struct_node.children[1])
@@ -420,6 +2546,7 @@ class Compiler:
             cursor += 1
         
         err_union_name = None
+        ok_type = None
 
         if return_type.startswith("$result{"):
             ok_type = return_type[8:-1]
@@ -451,6 +2578,8 @@ class Compiler:
             "return_type": return_type,
             "is_global": is_global,
             "throws_err": return_type == ("struct %s" % err_union_name),
+            "ok_type": ok_type,
+            "object": self.current_object.target_name,
             "body_node": func_node.children[cursor]
         }
         self.function_infos[glob_name] = function_info
@@ -463,6 +2592,14 @@ class Compiler:
     def write_standard_defs(self):
         target = OutputTarget.PreDecl if self.current_object.target_type == ObjectType.Process else OutputTarget.Header
         self.current_object.write(target, "#define %s %s\n" % (self.error_type_name, self.error_type))
+        # returned by $result fns under the outparam abi when there is no error, error codes start at 0
+        self.current_object.write(target, "#define CAL_ERR_NONE (-1)\n")
+        self.current_object.write(target, "#define CAL_LIKELY(x) __builtin_expect(!!(x), 1)\n")
+        # typed $buffer{} arrays start on a vector register boundary
+        self.current_object.write(target, "#define CAL_SIMD_ALIGN %s\n" % SIMD_ALIGNMENT)
+        # bytes of a pool.cal slab holding count objects, what $poolsize{} compiles to
+        pool_class = "".join("(size) <= %s ? %s : " % (size_class, size_class) for size_class in POOL_SIZE_CLASSES)
+        self.current_object.write(target, "#define CAL_POOL_SLAB(size, count) ((size_t)%s + (size_t)(count) * (size_t)(%s(size)))\n" % (POOL_SLAB_HEADER, pool_class))
 
     def reset_counters(self):
         self.while_counter = 0
@@ -492,9 +2629,11 @@ class Compiler:
         obj_name = self.current_object.get_name()
         self.print_message_begin("library", obj_name) #print("Compiling library: %s" % obj_name)
 
-        self.compile_code_unit(lib_node.children[1])
+        with Timings.phase("compile_code_unit"):
+            self.compile_code_unit(lib_node.children[1])
 
-        self.current_object.export()
+        with Timings.phase("export"):
+            self.current_object.export()
         self.current_object.compile(clibs=self.c_libs, **self.compilation_args)
 
         print("done.")
@@ -525,9 +2664,11 @@ class Compiler:
         # self.write_standard_headers()
         # self.write_standard_defs()
 
-        self.compile_code_unit(proc_node.children[1])
+        with Timings.phase("compile_code_unit"):
+            self.compile_code_unit(proc_node.children[1])
 
-        self.current_object.export()
+        with Timings.phase("export"):
+            self.current_object.export()
         self.current_object.compile(clibs=self.c_libs, **self.compilation_args)
 
         print("done.")
@@ -555,7 +2696,9 @@ class Compiler:
         self.current_object.write(target, "};\n")
 
         if is_global:
-            self.current_object.write_pre_decl("#define %s %s\n" % (name, visible_name))
+            self.current_object.define_local(name, visible_name)
+        else:
+            self.current_object.target_local_symbols.append(visible_name)
 
         """
         self.current_object.write(target, "struct ", visible_name, "{\n" )
@@ -580,30 +2723,93 @@ class Compiler:
         self.current_object.write_source("offsetof(struct %s, %s)" % (name, macro_node.children[1]))
 
     def compile_code_unit(self, unit_body):
+        module = self.lower_code_unit(unit_body)
+        PassManager(self.compilation_args).run(module, self)
+
+        if self.compilation_args.get("dump_ir", False):
+            path = os.path.join(CurrentProject.output_dir, "%s.ir" % self.current_object.get_name())
+            os.makedirs(CurrentProject.output_dir, exist_ok=True)
+            write_if_changed(path, module.dump())
+
+        self.emit_module(module)
+
+    def lower_code_unit(self, unit_body):
+        module = IRModule(name=self.current_object.target_name, object=self.current_object)
+
         for item in unit_body.children:
             match item.data:
-                case "c_include":
-                    self.compile_c_include(item)
+                case "link":
+                    self.compile_link(item)
                 case "c_lib":
                     self.compile_c_lib(item)
+                case "error_set":
+                    self.compile_error_set(item)
+                case "export_mode":
+                    self.set_export_mode(item)
                 case "function":
-                    self.compile_function(item)
+                    module.items.append(self.lower_function(item))
                 case "static_allocation":
-                    self.compile_static_allocation(item)
-                case "link":
-                    self.compile_link(item)
-                case "raw_c_statement":
-                    self.compile_inline_c(item)
+                    module.statics[str(item.children[1])] = self.get_c_type(str(item.children[0]))
+                    module.items.append(item)
                 case "struct_def":
                     continue
-                case "debug_if":
-                    self.compile_debug_if(item)
-                #    self.compile_struct_def(item)
-                case "error_set":
-                    self.compile_error_set(item)
+                case "c_include" | "raw_c_statement" | "debug_if":
+                    module.items.append(item)
                 case _:
                     print("Error compiling code unit, unexpected item %s" % item)
 
+        return module
+
+    def lower_function(self, func_node):
+        cursor = 1 if func_node.children[0] == "glob" else 0
+        name = str(func_node.children[cursor])
+
+        # a signature naming a struct from a linked lib can't be read before the link
+        # is compiled, populate_item_infos leaves it for here
+        if not name in self.function_infos and self.uses_linked_struct(func_node):
+            self.get_function_info(func_node)
+
+        if not name in self.function_infos:
+            print("Problem with function infos")
+            print("function %s not found" % name)
+            print("line: %s, %s" % (func_node.meta.container_line, func_node.meta.container_column))
+            raise NameError
+
+        func_info = self.function_infos[name]
+        return IRFunction(
+            name=name,
+            global_name=func_info["global_name"],
+            params=func_info["params"],
+            return_type=func_info["return_type"],
+            is_global=func_info["is_global"],
+            throws_err=func_info["throws_err"],
+            ok_type=func_info["ok_type"],
+            restrict_params=self.get_simd_params(func_info["params"], func_info["body_node"]),
+            body=copy_ir_tree(func_info["body_node"]),
+            node=func_node,
+        )
+
+    def get_simd_params(self, params, body):
+        # $simd promises that the buffers its loop dereferences do not overlap
+        pointers = set(name for c_type, name in params if c_type.endswith("*"))
+        names = set()
+        for loop in body.find_data("simd_loop"):
+            names.update(str(node.children[1]) for node in loop.find_data("deref_var") if str(node.children[1]) in pointers)
+        return names
+
+    def emit_module(self, module):
+        for item in module.items:
+            if isinstance(item, IRFunction):
+                self.compile_function(item)
+            elif item.data == "c_include":
+                self.compile_c_include(item)
+            elif item.data == "static_allocation":
+                self.compile_static_allocation(item)
+            elif item.data == "raw_c_statement":
+                self.compile_inline_c(item)
+            elif item.data == "debug_if":
+                self.compile_debug_if(item)
+
             self.current_object.write_source("\n")
 
     def compile_c_lib(self, lib):
@@ -611,17 +2817,24 @@ class Compiler:
 
 
     def compile_link(self, link_node):
-        global CurrentProject, Parser, errors, current_file
+        global CurrentProject, Modules, errors, current_file
         for link in link_node.children:
-            if link in CurrentProject.required_links_for_proc_main or link in CurrentProject.dependancy_stack:
+            in_progress = link in CurrentProject.dependancy_stack and not link in CurrentProject.required_links_for_proc_main
+            target_file = "" if in_progress else CurrentProject.search_file(link + ".cal")
+            module = Modules.get(target_file, self.compilation_args) if target_file != "" else None
+
+            if module != None:
+                Modules.avoided_parses += 1
+                self.import_module(module)
+            elif in_progress or link in CurrentProject.required_links_for_proc_main:
                 spoof = ObjectInfo(ObjectType.Library)
                 spoof.target_name = str(link)
                 spoof.update_names()
 
                 self.current_object.target_link_objects.append(spoof.target_name)
+                self.current_object.target_include_objects.append(spoof.target_name)
                 self.current_object.write_pre_decl("#include \"%s\"\n" % spoof.target_header_name)
             else:
-                target_file = CurrentProject.search_file(link + ".cal")
                 if target_file == "":
                     print("Link error on line %s, %s: Could not locate file '%s.cal' in provided search paths" % (link_node.meta.container_line, link_node.meta.container_column, link))
                     raise FileNotFoundError
@@ -634,7 +2847,8 @@ class Compiler:
                     target_code = f.read()
                 _errors = errors
                 errors = 0
-                parsed = Parser.parse(target_code, on_error=parser_error)
+                parsed = parse_code(target_code)
+                Modules.parses += 1
 
                 if errors != 0:
                     print("Error compiling %s, aborting due to %s errors" % (target_file, errors))
@@ -642,43 +2856,51 @@ class Compiler:
                 errors = _errors
 
                 library_compiler = Compiler()
+                library_compiler.compile(parsed, **self.compilation_args)
 
-                #for key, fdef in self.function_infos.items():
-                #    if key.startswith(self.current_object.target_name + "_"):
-                #        library_compiler.function_infos[key] = fdef
-                
-                #for key, err in self.error_structs.items():
-                #    library_compiler.error_structs[key] = err
-                
-                #for key, err in self.error_sets.items():
-                #    library_compiler.error_sets[key] = err
+                module = Modules.register(target_file, parsed, library_compiler)
+                self.import_module(module)
 
-                library_compiler.compile(parsed, **self.compilation_args)
+                current_file = c_file
+
+    def import_module(self, module):
+        global CurrentProject
 
-                for obj in library_compiler.objects:
-                    if not obj in self.objects:
-                        self.objects.append(obj)
+        if not module.path in self.imported_modules:
+            self.imported_modules.append(module.path)
 
-                    if not obj.target_name in CurrentProject.required_links_for_proc_main:
-                        CurrentProject.required_links_for_proc_main.append(obj.target_name)
-                        self.current_object.write_pre_decl("#include \"%s\"\n" % obj.target_header_name)
+        for obj in module.objects:
+            if not any(obj is other for other in self.objects):
+                self.objects.append(obj)
 
-                for key, fdef in library_compiler.function_infos.items():
-                    if key.startswith(library_compiler.current_object.target_name + "_"):
-                        self.function_infos[key] = fdef
+            if obj.target_type != ObjectType.Library:
+                continue
 
-                for key, err in library_compiler.error_structs.items():
-                    self.error_structs[key] = err
+            if not obj.target_name in CurrentProject.required_links_for_proc_main:
+                CurrentProject.required_links_for_proc_main.append(obj.target_name)
 
-                for key, err in library_compiler.error_sets.items():
-                    self.error_sets[key] = err
+            if not obj.target_name in self.current_object.target_include_objects:
+                self.current_object.target_include_objects.append(obj.target_name)
+                self.current_object.write_pre_decl("#include \"%s\"\n" % obj.target_header_name)
+                # a lib's header can name the linked lib's structs, in its $result{} unions
+                if self.current_object.target_type == ObjectType.Library:
+                    self.current_object.write_header("#include \"%s\"\n" % obj.target_header_name)
 
-                for lib in library_compiler.c_libs:
-                    self.c_libs.append(lib)
+        for key, fdef in module.function_infos.items():
+            self.function_infos[key] = fdef
 
-                current_file = c_file
+        for key, info in module.struct_infos.items():
+            self.struct_infos[key] = info
 
-        
+        for key, err in module.error_structs.items():
+            self.error_structs[key] = err
+
+        for key, err in module.error_sets.items():
+            self.error_sets[key] = err
+
+        for lib in module.c_libs:
+            if not lib in self.c_libs:
+                self.c_libs.append(lib)
 
     def compile_c_include(self, c_include):
         self.current_object.write_source("#include <", str(c_include.children[0])[1:-1], ">\n")
@@ -690,6 +2912,8 @@ class Compiler:
             target = OutputTarget.PreDecl
 
         visible_name = "%s_%s" % (self.current_object.target_name, struct_name)
+        section = "pre_decl" if target == OutputTarget.PreDecl else "header"
+        start = len(self.current_object.get_emitter(section))
 
         self.current_object.write(target, "struct %s {\n" % (visible_name))
         self.current_object.write(target, "    bool is_error;\n    union{\n")
@@ -698,41 +2922,111 @@ class Compiler:
             self.current_object.write(target, "    %s RESULT_ERROR;\n    int RESULT_OK;\n    };\n};\n\n" % (self.error_type_name))
         else:
             self.current_object.write(target, "    %s RESULT_ERROR;\n    %s RESULT_OK;\n    };\n};\n\n" % (self.error_type_name, ok_type))
+        self.current_object.mark_span(visible_name, section, start)
         self.error_structs[visible_name] = 1
 
         if self.current_object.target_type != ObjectType.Process:
-            self.current_object.write_pre_decl("#define %s %s\n" % (struct_name, visible_name))
+            self.current_object.define_local(struct_name, visible_name)
 
-    def compile_function(self, func_node):
-        cursor = 0
-        is_global = False
-        if func_node.children[cursor] == "glob":
-            is_global = True
-            cursor += 1
-        name = str(func_node.children[cursor])
+    def set_export_mode(self, node):
+        mode = str(node.children[0])
 
-        if not name in self.function_infos:
-            print("Problem with function infos")
-            print("function %s not found" % name)
-            print("line: %s, %s" % (func_node.meta.container_line, func_node.meta.container_column))
-            raise NameError
-        
-        func_info = self.function_infos[name]
-        is_global = func_info["is_global"]
-        global_name = func_info["global_name"]
-        params = func_info["params"]
-        return_type = func_info["return_type"]
-        body_node = func_info["body_node"]
+        if not mode in EXPORT_MODES:
+            print("Error on line %s, %s: Unknown export mode %s, expected one of %s" % (node.meta.container_line, node.meta.container_column, mode, ", ".join(EXPORT_MODES)))
+            raise SyntaxError
+
+        self.export_mode = mode
+
+    def get_export_mode(self, function):
+        if not function.is_global or self.current_object.target_type != ObjectType.Library:
+            return None
+
+        # cal.toml overrides the lib's own $export directive
+        modes = self.compilation_args.get("export_modes", {})
+        mode = modes.get(self.current_object.target_name, self.export_mode or modes.get("default", "wrapper"))
+
+        if not mode in EXPORT_MODES:
+            print("Unknown export mode %s for lib %s, expected one of %s" % (mode, self.current_object.target_name, ", ".join(EXPORT_MODES)))
+            raise SyntaxError
+
+        if mode == "inline" and not self.is_header_inlinable(function):
+            return "direct"
+        return mode
+
+    def is_header_inlinable(self, function):
+        # small leaf functions only, everything the body touches has to be visible from the header
+        count = 0
+        for node in function.body.iter_subtrees():
+            count += 1
+            if node.data in HEADER_INLINE_BLOCKERS:
+                return False
+            if node.data in ("var", "deref_var"):
+                name = str(node.children[1] if node.data == "deref_var" else node.children[0])
+                set_name = name.split(".")[0]
+                if name in function.symbols:
+                    continue
+                if "." in name and set_name in self.error_sets and self.error_sets[set_name]["object"] == self.current_object.target_name:
+                    continue
+                return False
+
+        return count <= HEADER_INLINE_MAX_NODES
+
+    def uses_result_out_param(self, ok_type):
+        return self.compilation_args.get("result_abi", "struct") == "outparam" and ok_type != "void"
+
+    def get_function_signature(self, function):
+        # the c return type and parameters of a function under the selected result abi
+        params = [("%s restrict" % c_type if name in function.restrict_params else c_type, name) for c_type, name in function.params]
+        if not function.throws_err or self.compilation_args.get("result_abi", "struct") != "outparam":
+            return function.return_type, params
+
+        if function.ok_type == "void":
+            return self.error_type_name, params
+        return self.error_type_name, params + [("%s*" % function.ok_type, "_RESULT_OUT")]
+
+    def compile_function(self, function):
+        name = function.name
+        return_type, params = self.get_function_signature(function)
 
         self.deferred_statements = []
 
-        self.current_object.target_functions.append({ "name": name, "params": params, "returns": return_type, "is_global": is_global })
+        mode = self.get_export_mode(function)
 
-        if is_global:
-            self.current_object.target_exported_functions.append( { "name": global_name, "params": params, "returns": return_type, "link": name })
-        else:
+        if function.throws_err:
+            union_name = function.return_type[len("struct "):]
+            self.current_object.target_union_users.setdefault(union_name, set()).add(function.name)
+
+        if mode == "inline":
+            # the whole definition goes into the header, callers in other objects can inline it
+            self.current_object.define_local(name, function.global_name)
+            self.current_object.write_header("static inline ")
+            with self.current_object.redirect_source(self.current_object.target_header_body):
+                self.header_inline = True
+                self.compile_function_definition(function, function.global_name)
+                self.header_inline = False
+            return
+
+        if mode == "direct":
+            self.current_object.define_local(name, function.global_name)
+            name = function.global_name
+
+        is_public = mode == "direct"
+        is_static = not function.is_global or mode == "alias"
+        self.current_object.target_functions.append({ "name": name, "params": params, "returns": return_type, "is_global": not is_static, "public": is_public, "key": function.name })
+
+        if function.is_global:
+            self.current_object.target_exported_functions.append( { "name": function.global_name, "params": params, "returns": return_type, "link": name, "mode": mode, "key": function.name })
+
+        start = len(self.current_object.target_source_body)
+        if is_static:
             self.current_object.write_source("static ")
 
+        self.compile_function_definition(function, name)
+        self.current_object.mark_span(function.name, "source", start)
+
+    def compile_function_definition(self, function, name):
+        return_type, params = self.get_function_signature(function)
+
         self.current_object.write_source(return_type, " ", name, "(")
 
         i = 0
@@ -744,12 +3038,20 @@ class Compiler:
 
         self.current_object.write_source(")")
 
-        if func_info["throws_err"]:
-            self.current_error_struct_type = return_type
+        if function.throws_err:
+            self.current_error_struct_type = function.return_type
+            self.current_ok_type = function.ok_type
 
-        self.compile_code_body(body_node)
+        self.current_function = function
+        self.current_return_type = return_type
+        self.defer_exit = self.get_defer_exit(function, return_type)
+        self.compile_code_body(function.body, "_TAIL_START" if function.tail_loop else None)
+        self.defer_exit = None
+        self.current_function = None
+        self.current_return_type = None
 
         self.current_error_struct_type = None
+        self.current_ok_type = None
 
     def get_global_struct_name(self, name):
         if name in self.struct_infos:
@@ -852,6 +3154,8 @@ class Compiler:
                     self.compile_inline_c(item)
                 case "return_statement":
                     self.compile_return(item)
+                case "tail_call":
+                    self.compile_tail_call(item)
                 case "expression":
                     self.compile_expression(item)
                     self.current_object.write_source(";\n")
@@ -873,6 +3177,12 @@ class Compiler:
                     self.compile_do_while(item)
                 case "for_statement":
                     self.compile_for(item)
+                case "simd_loop":
+                    self.compile_simd_loop(item)
+                case "loop_block":
+                    self.compile_loop_block(item)
+                case "loop_temp":
+                    self.compile_loop_temp(item)
                 case "defer_statement":
                     self.compile_defer(item)
 
@@ -886,10 +3196,13 @@ class Compiler:
         set_name = str(error_set.children[0])
         target = OutputTarget.Header
 
-        if set_name in self.error_sets:
+        # sets imported from linked modules can share a name with this object's sets
+        if set_name in self.error_sets and self.error_sets[set_name]["object"] == self.current_object.target_name:
             print("Error on line %s, %s: ErrorSet %s redefinition" % (error_set.meta.container_line, error_set.meta.container_column, set_name))
             raise SyntaxError
 
+        self.error_sets[set_name] = { "object": self.current_object.target_name, "codes": [str(code) for code in error_set.children[1:]] }
+
         if self.current_object.target_type == ObjectType.Process:
             target = OutputTarget.PreDecl
 
@@ -899,10 +3212,11 @@ class Compiler:
             err_name = "%s_%s" % (set_name, err_code)
             visible_name = "%s_%s" % (self.current_object.target_name, err_name) if target == OutputTarget.Header else err_name
 
-            self.current_object.write(target, "#define %s %s\n" % (visible_name, self.error_index_counter))
-
             if target == OutputTarget.Header:
-                self.current_object.write_pre_decl("#define %s %s\n" % (err_name, self.error_index_counter))
+                self.current_object.write_header("#define %s %s\n" % (visible_name, self.error_index_counter))
+                self.current_object.define_local(err_name, self.error_index_counter)
+            else:
+                self.current_object.define_local(visible_name, self.error_index_counter)
 
             self.error_index_counter += 1
 
@@ -914,23 +3228,42 @@ class Compiler:
         #if func_node.children[0].children[0] != None:
         #    func_name = "%s_%s" % (func_node.children[0].children[0], func_name)
         
-        func_name = self.compile_name_chain(func_node.children[0].children[0])
+        call_node = func_node.children[0] if func_node.data == "inline_call" else func_node
+        func_name = self.compile_name_chain(call_node.children[0].children[0])
 
         if not func_name in self.function_infos:
             print("Error on line %s, %s: Try statement was used on a function that does not return a result type" % (try_node.meta.container_line, try_node.meta.container_column))
             raise LookupError
 
         func_info = self.function_infos[func_name]
+        ok_type = func_info["ok_type"]
 
         result_name = "_RESULT_%s" % self.delta
         self.delta += 1
 
-        self.current_object.write_source("%s %s = " % (func_info["return_type"], result_name))
+        if self.compilation_args.get("result_abi", "struct") == "outparam":
+            error_name = "%s_ERR" % result_name
+            ok_value = result_name
+
+            if self.uses_result_out_param(ok_type):
+                self.current_object.write_source("%s %s;\n    " % (ok_type, result_name))
+                self.result_out_target = "&%s" % result_name
+
+            self.current_object.write_source("%s %s = " % (self.error_type_name, error_name))
+            self.compile_expression(func_node)
+            self.result_out_target = None
+            self.current_object.write_source(";\n    ")
+
+            self.current_object.write_source("if(CAL_LIKELY(%s == CAL_ERR_NONE)){\n" % error_name)
+        else:
+            error_name = "%s.RESULT_ERROR" % result_name
+            ok_value = "%s.RESULT_OK" % result_name
 
-        self.compile_expression(func_node)
-        self.current_object.write_source(";\n    ")
+            self.current_object.write_source("%s %s = " % (func_info["return_type"], result_name))
+            self.compile_expression(func_node)
+            self.current_object.write_source(";\n    ")
 
-        self.current_object.write_source("if(!%s.is_error){\n" % result_name)
+            self.current_object.write_source("if(CAL_LIKELY(!%s.is_error)){\n" % result_name)
         cursor = 1
 
         if try_node.children[cursor] != None:
@@ -940,7 +3273,7 @@ class Compiler:
             ok_name = str(try_node.children[cursor])
             cursor += 1
 
-            self.current_object.write_source("    %s %s = %s.RESULT_OK;\n" % (ok_type, ok_name, result_name))
+            self.current_object.write_source("    %s %s = %s;\n" % (ok_type, ok_name, ok_value))
             
             for i in range(cursor, len(try_node.children)-1):
                 if try_node.children[i] == None:
@@ -949,7 +3282,7 @@ class Compiler:
             
         self.current_object.write_source("    } else {\n    ")
         catch_node = try_node.children[-1]
-        self.current_object.write_source("%s %s = %s.RESULT_ERROR;\n" % (self.error_type_name, catch_node.children[0], result_name))
+        self.current_object.write_source("%s %s = %s;\n" % (self.error_type_name, catch_node.children[0], error_name))
 
         for i in range(1, len(catch_node.children)):
             self.compile_statement(catch_node.children[i])
@@ -957,32 +3290,181 @@ class Compiler:
         self.current_object.write_source("    } //END TRY/CATCH STMT\n")
 
 
-    def compile_code_body(self, body_node):
+    def compile_code_body(self, body_node, start_label=None):
         self.current_object.write_source("{\n")
 
+        if self.defer_exit != None and self.defer_exit[1] != None:
+            self.current_object.write_source("%s %s = {0};\n" % self.defer_exit)
+
+        if start_label != None:
+            self.current_object.write_source("%s: ;\n" % start_label)
+
         for item in body_node.children:
             self.compile_statement(item)
 
 
-        self.expand_defers()
+        if self.defer_exit != None:
+            self.expand_defer_chain()
+        else:
+            self.expand_defers()
         self.current_object.write_source("}\n\n")
 
+    def get_defer_exit(self, function, return_type):
+        # the (c type, name) of the return value temporary when the fn's defers are lowered to a cleanup chain
+        if self.compilation_args.get("defer_lowering", "cleanup") != "cleanup":
+            return None
+
+        # the chain sits at the end of the body, a defer inside a nested block
+        # could name locals that are out of scope there, those fns keep the copies
+        top_level = sum(1 for item in function.body.children if isinstance(item, lark.Tree) and item.data == "defer_statement")
+        count = 0
+        pending = [function.body]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node.data == "defer_statement":
+                count += 1
+            if node.data != "inline_call":
+                pending.extend(child for child in node.children if isinstance(child, lark.Tree))
+
+        if top_level == 0 or top_level != count:
+            return None
+        return (return_type, "_DEFER_RET" if return_type != "void" else None)
+
     def expand_defers(self):
         if len(self.deferred_statements) > 0:
             defers = reversed(self.deferred_statements)
             for defer in defers:
                 self.compile_statement(defer)
 
+    def expand_defer_chain(self):
+        # every defer once, a return with N defers registered jumps to _DEFER_<N-1> and falls through the rest
+        for i in reversed(range(len(self.deferred_statements))):
+            self.current_object.write_source("_DEFER_%s: ;\n" % i)
+            self.compile_statement(self.deferred_statements[i])
+
+        return_name = self.defer_exit[1]
+        self.current_object.write_source("return%s;\n" % (" " + return_name if return_name != None else ""))
+
     def compile_return(self, return_node):
+        if self.defer_exit != None and self.inline_exit == None and len(self.deferred_statements) > 0:
+            # the value is computed before any defer runs
+            return_name = self.defer_exit[1]
+            if len(return_node.children) > 0:
+                if return_name != None:
+                    self.current_object.write_source("%s = " % return_name)
+                self.compile_returned_value(return_node.children[0])
+                self.current_object.write_source(";\n")
+            self.current_object.write_source("goto _DEFER_%s;\n" % (len(self.deferred_statements) - 1))
+            return
+
+        if self.inline_exit == None and len(self.deferred_statements) > 0 and len(return_node.children) > 0:
+            # the copies run after the value is computed, the same order as the cleanup chain
+            self.current_object.write_source("{\n")
+            return_name = None
+            if self.current_return_type != "void":
+                return_name = "_RETURN_%s" % self.delta
+                self.delta += 1
+                self.current_object.write_source("%s %s = " % (self.current_return_type, return_name))
+            self.compile_returned_value(return_node.children[0])
+            self.current_object.write_source(";\n")
+            self.expand_defers()
+            self.current_object.write_source("return%s;\n}\n" % (" " + return_name if return_name != None else ""))
+            return
+
         self.expand_defers()
 
+        if self.inline_exit != None:
+            # inside an inlined body a return stores the value and jumps to the end of the copy
+            return_name, exit_label = self.inline_exit
+            if len(return_node.children) > 0:
+                if return_name != None:
+                    self.current_object.write_source("%s = " % return_name)
+                self.compile_returned_value(return_node.children[0])
+                self.current_object.write_source(";\n")
+            self.current_object.write_source("goto %s;\n" % exit_label)
+            return
+
         self.current_object.write_source("return ")
 
         if len(return_node.children) > 0:
-            self.compile_expression(return_node.children[0])
+            self.compile_returned_value(return_node.children[0])
         
         self.current_object.write_source(";\n")
 
+    def compile_tail_call(self, node):
+        # the same order as `return f(...)`, the arguments are evaluated before the defers run
+        call = node.children[0]
+        arguments = call.children[1].children[:-1] if len(call.children) > 1 else []
+        params = self.current_function.params
+
+        self.current_object.write_source("{\n")
+        for i in range(len(params)):
+            self.current_object.write_source("%s _TAIL_ARG_%s = " % (params[i][0], i))
+            self.compile_expression(arguments[i])
+            self.current_object.write_source(";\n")
+        self.expand_defers()
+        for i in range(len(params)):
+            self.current_object.write_source("%s = _TAIL_ARG_%s;\n" % (params[i][1], i))
+        self.current_object.write_source("goto _TAIL_START;\n}\n")
+
+    def compile_returned_value(self, value):
+        # returning another $result fn's result hands it our own out pointer
+        called = self.get_called_function(value)
+        if called != None and called["throws_err"] and self.current_ok_type != None and self.uses_result_out_param(self.current_ok_type):
+            self.result_out_target = self.result_out_name
+        self.compile_expression(value)
+
+    def compile_inline_call(self, node):
+        out_target = self.result_out_target
+        self.result_out_target = None
+
+        call, params, body = node.children
+        function = self.get_called_function(call)
+        # the copy uses the callee's error union and its lib's names, keep both alive
+        self.record_reference(function)
+        arguments = call.children[1].children[:-1] if len(call.children) > 1 else []
+
+        index = self.delta
+        self.delta += 1
+        return_name = "_INLINE_RET_%s" % index
+        out_name = "_INLINE_OUT_%s" % index
+        exit_label = "_INLINE_END_%s" % index
+
+        ok_type = function["ok_type"]
+        return_type = function["return_type"]
+        if function["throws_err"] and self.compilation_args.get("result_abi", "struct") == "outparam":
+            return_type = self.error_type_name
+
+        # a gnu statement expression, the copy's value is the value of its last statement
+        self.current_object.write_source("({\n")
+        for (c_type, _), name, argument in zip(function["params"], params.children, arguments):
+            self.current_object.write_source("%s %s = " % (c_type, name))
+            self.compile_expression(argument)
+            self.current_object.write_source(";\n")
+
+        if function["throws_err"] and self.uses_result_out_param(ok_type):
+            self.current_object.write_source("%s* %s = %s;\n" % (ok_type, out_name, out_target if out_target != None else "&(%s){0}" % ok_type))
+        if return_type != "void":
+            self.current_object.write_source("%s %s;\n" % (return_type, return_name))
+
+        saved = (self.deferred_statements, self.current_error_struct_type, self.current_ok_type, self.result_out_name, self.inline_exit, self.defer_exit)
+        self.deferred_statements = []
+        self.defer_exit = None
+        self.current_error_struct_type = function["return_type"] if function["throws_err"] else None
+        self.current_ok_type = ok_type
+        self.result_out_name = out_name
+        self.inline_exit = (return_name if return_type != "void" else None, exit_label)
+
+        for statement in body.children:
+            self.compile_statement(statement)
+
+        self.deferred_statements, self.current_error_struct_type, self.current_ok_type, self.result_out_name, self.inline_exit, self.defer_exit = saved
+
+        self.current_object.write_source("%s: ;\n" % exit_label)
+        if return_type != "void":
+            self.current_object.write_source("%s;\n" % return_name)
+        self.current_object.write_source("})")
+
     def compile_expression(self, expression):
         expr = expression
         if expr.data == "expression":
@@ -1033,6 +3515,10 @@ class Compiler:
                 self.compile_not(expr)
             case "func_call":
                 self.compile_func_call(expr)
+            case "inline_call":
+                self.compile_inline_call(expr)
+            case "comma":
+                self.compile_comma(expr)
             case "var":
                 self.compile_var(expr)
             case "deref_var":
@@ -1051,6 +3537,10 @@ class Compiler:
                 self.compile_group(expr)
             case "value":
                 self.compile_value(expr)
+            case "true" | "false":
+                self.current_object.write_source(expr.data)
+            case "null":
+                self.current_object.write_source("NULL")
             case "ref":
                 self.compile_ref(expr)
             case "bin_or":
@@ -1067,6 +3557,8 @@ class Compiler:
                 self.compile_bin_not(expr)
             case "macro_sizeof":
                 self.compile_macro_sizeof(expr)
+            case "macro_poolsize":
+                self.compile_macro_poolsize(expr)
             case "struct_member_offset":
                 self.compile_struct_member_macro(expr)
             case "va_arg":
@@ -1084,6 +3576,19 @@ class Compiler:
                 #compile va_args...
 
     def compile_ok_result(self, expr):
+        if self.compilation_args.get("result_abi", "struct") == "outparam":
+            if expr.children[0] == None:
+                self.current_object.write_source("CAL_ERR_NONE")
+                return
+
+            if self.uses_result_out_param(self.current_ok_type):
+                self.current_object.write_source("(*%s = (" % self.result_out_name)
+            else:
+                self.current_object.write_source("((void)(")
+            self.compile_expression(expr.children[0])
+            self.current_object.write_source("), CAL_ERR_NONE)")
+            return
+
         self.current_object.write_source("(%s){ .is_error = 0, .RESULT_OK = " % self.current_error_struct_type)
         if expr.children[0] != None:
             self.compile_expression(expr.children[0])
@@ -1094,6 +3599,12 @@ class Compiler:
     def compile_err_result(self, expr):
         #errcode_name = "%s_%s" % (expr.children[0], expr.children[1])
         #self.current_object.write_source("(%s){ .is_error = 1, .RESULT_ERROR = %s }" % (self.current_error_struct_type, errcode_name))
+        if self.compilation_args.get("result_abi", "struct") == "outparam":
+            self.current_object.write_source("((%s)(" % self.error_type_name)
+            self.compile_expression(expr.children[0])
+            self.current_object.write_source("))")
+            return
+
         self.current_object.write_source("(%s) { .is_error = 1, .RESULT_ERROR = " % self.current_error_struct_type)
         self.compile_expression(expr.children[0])
         self.current_object.write_source("}")
@@ -1199,7 +3710,6 @@ class Compiler:
         self.compile_expression(node.children[0])
 
     def compile_not(self, node):
-        self.compile_expression(node.children[0])
         self.current_object.write_source(" !")
         self.compile_expression(node.children[0])
 
@@ -1254,6 +3764,10 @@ class Compiler:
             # be considered first with this one of the backburner.
             # Recommended Next: Error Unions and Catching, Testing + Build System
 
+        # only the outermost call of a try statement or return writes into the caller's result
+        out_target = self.result_out_target
+        self.result_out_target = None
+
         self.compile_expression(node.children[0])
         self.current_object.write_source("(")
 
@@ -1263,10 +3777,45 @@ class Compiler:
             if i + 1 < len(node.children):
                 self.current_object.write_source(", ")
 
+        called = self.get_called_function(node)
+        if called != None:
+            self.record_reference(called)
+        if called != None and called["throws_err"] and self.uses_result_out_param(called["ok_type"]):
+            if len(node.children) > 1:
+                self.current_object.write_source(", ")
+            # calls whose result is dropped still need somewhere to put the ok value
+            self.current_object.write_source(out_target if out_target != None else "&(%s){0}" % called["ok_type"])
+
         self.current_object.write_source(")")
 
+    def record_reference(self, info):
+        # call edges for dead code elimination, references from outside a function live as long as the object
+        caller = self.current_function.name if self.current_function != None else None
+        self.current_object.add_call(caller, info["object"], info["name"])
+
+    def get_called_function(self, node):
+        if not isinstance(node, lark.Tree):
+            return None
+        if node.data == "expression":
+            node = node.children[0]
+        if node.data == "inline_call":
+            node = node.children[0]
+        if node.data != "func_call" or node.children[0].data != "var":
+            return None
+        return self.function_infos.get(self.compile_name_chain(node.children[0].children[0]))
+
     def compile_var(self, node):
         var_name = self.compile_name_chain(node.children[0])
+
+        # a function used as a value, its address can be called from anywhere
+        if var_name in self.function_infos:
+            self.record_reference(self.function_infos[var_name])
+
+        if self.header_inline:
+            # the short error code names are only #defined in the lib's own source
+            set_name = str(node.children[0]).split(".")[0]
+            if set_name in self.error_sets and self.error_sets[set_name]["object"] == self.current_object.target_name:
+                var_name = "%s_%s" % (self.current_object.target_name, var_name)
         #if node.children[0] != None:
         #    var_name = "%s_%s" % (node.children[0], node.children[1])
         #else:
@@ -1274,11 +3823,24 @@ class Compiler:
 
         self.current_object.write_source(var_name)
 
+    def check_buffer_size(self, node, size):
+        # a runtime size would turn the array into a c vla, which can't take the = {0}
+        if not is_constant_size(size):
+            line, column = get_node_position(node)
+            print("Error on line %s, %s: $buffer{} size must be a compile time constant" % (line, column))
+            raise SyntaxError
+
     def compile_macro_buffer_bytes(self, static_keyword, c_type, c_name, node):
+        self.check_buffer_size(node, node.children[0])
         buffer_name = "_CAL__buffer%s___" % self.delta
         self.delta += 1
 
-        self.current_object.write_source(static_keyword, "char %s[%s] = {" % (buffer_name, node.children[0]), "0", "};\n")
+        if static_keyword != "":
+            self.current_object.target_local_symbols.append(buffer_name)
+
+        self.current_object.write_source(static_keyword, "char %s[" % buffer_name)
+        self.compile_expression(node.children[0])
+        self.current_object.write_source("] = {", "0", "};\n")
 
         if static_keyword == "":
             self.current_object.write_source("    ")
@@ -1287,13 +3849,18 @@ class Compiler:
 
 
     def compile_macro_buffer_typed(self, static_keyword, c_type, c_name, node):
+        self.check_buffer_size(node, node.children[1])
         buffer_name = "_CAL__buffer%s___" % self.delta
         self.delta += 1
 
+        if static_keyword != "":
+            self.current_object.target_local_symbols.append(buffer_name)
+
         buffer_type = self.get_c_type(str(node.children[0]))
-        buffer_count = str(node.children[1])
 
-        self.current_object.write_source(static_keyword, buffer_type, " ", buffer_name, "[", buffer_count, "] = {", "0", "};\n")
+        self.current_object.write_source(static_keyword, buffer_type, " ", buffer_name, "[")
+        self.compile_expression(node.children[1])
+        self.current_object.write_source("] __attribute__((aligned(CAL_SIMD_ALIGN))) = {", "0", "};\n")
 
         if static_keyword == "":
             self.current_object.write_source("    ")
@@ -1301,8 +3868,12 @@ class Compiler:
         self.current_object.write_source(static_keyword, c_type, " ", c_name, " = ", buffer_name, ";\n")
 
     def compile_macro_buffer_struct(self, static_keyword, c_type, c_name, node):
+        self.check_buffer_size(node, node.children[1])
         buffer_name = "_CAL_buffer%s___" % self.delta
         self.delta += 1
+
+        if static_keyword != "":
+            self.current_object.target_local_symbols.append(buffer_name)
         # TEST THIS STILL
         #struct_name = str(node.children[1])
 
@@ -1311,9 +3882,9 @@ class Compiler:
         
         struct_name = self.compile_name_chain(node.children[0])
 
-        buffer_count = str(node.children[1])
-
-        self.current_object.write_source(static_keyword, struct_name, " ", buffer_name, "[", buffer_count, "] = {", "0", "};\n")
+        self.current_object.write_source(static_keyword, struct_name, " ", buffer_name, "[")
+        self.compile_expression(node.children[1])
+        self.current_object.write_source("] __attribute__((aligned(CAL_SIMD_ALIGN))) = {", "0", "};\n")
 
         if static_keyword == "":
             self.current_object.write_source("    ")
@@ -1347,17 +3918,7 @@ class Compiler:
         self.current_object.write_source(var_name)
 
         for offset in static_offsets:
-            if offset.data == "static_plus":
-                self.current_object.write_source("+")
-            elif offset.data == "static_minus":
-                self.current_object.write_source("-")
-            else:
-                print("Unexpected offset token %s" % offset.data);
-            
-            try:
-                self.compile_expression(offset.children[0])
-            except Exception as ex:
-                self.current_object.write_source(str(offset.children[0]))
+            self.compile_static_offset(offset)
 
         self.current_object.write_source(")")
 
@@ -1379,20 +3940,25 @@ class Compiler:
         self.compile_expression(func_call)
 
         for offset in static_offsets:
-            if offset.data == "static_plus":
-                self.current_object.write_source("+")
-            elif offset.data == "static_minus":
-                self.current_object.write_source("-")
-            else:
-                print("Unexpected offset token %s" % offset.data)
-            
-            try:
-                self.compile_expression(offset.children[0])
-            except:
-                self.current_object.write_source(str(offset.children[0]))
-        
+            self.compile_static_offset(offset)
+
         self.current_object.write_source(")")
 
+    def compile_static_offset(self, offset):
+        if offset.data == "static_plus":
+            self.current_object.write_source("+")
+        elif offset.data == "static_minus":
+            self.current_object.write_source("-")
+        else:
+            print("Unexpected offset token %s" % offset.data)
+
+        # NUMBER and NAME offsets are plain tokens, macros are trees
+        value = offset.children[0]
+        if isinstance(value, lark.Tree):
+            self.compile_expression(value)
+        else:
+            self.current_object.write_source(str(value))
+
     def compile_ref(self, node):
         self.current_object.write_source("&")
         self.compile_expression(node.children[0])
@@ -1422,6 +3988,7 @@ class Compiler:
         self.current_object.write_source(str(node.children[0]))
 
     def compile_static_allocation(self, alloc_node):
+        self.current_object.target_local_symbols.append(str(alloc_node.children[1]))
         self.compile_allocation(alloc_node, True)
 
     def compile_stack_alloc(self, alloc_node):
@@ -1465,7 +4032,7 @@ class Compiler:
             if value_node.data == "static_array":
                 self.compile_static_array(value_node)
             else:
-                self.current_object.write_source(str(value_node.children[0]))
+                self.compile_expression(value_node)
         else:
             self.current_object.write_source(c_type, " ", c_name)
 
@@ -1488,12 +4055,22 @@ class Compiler:
     def compile_inline_c(self, inline_c):
         raw_c = inline_c.children[0]
         c_code = str(raw_c)[4:-2]
+
+        for identifier in set(re.findall(r"[A-Za-z_]\w*", c_code)):
+            if identifier in self.function_infos:
+                self.record_reference(self.function_infos[identifier])
         self.current_object.write_source(c_code.strip(), "\n")
 
     def compile_macro_sizeof(self, node):
         c_type = self.get_c_type(str(node.children[0]))
         self.current_object.write_source("sizeof(%s)" % c_type)
 
+    def compile_macro_poolsize(self, node):
+        c_type = self.get_c_type(str(node.children[0]))
+        self.current_object.write_source("CAL_POOL_SLAB(sizeof(%s), " % c_type)
+        self.compile_expression(node.children[1])
+        self.current_object.write_source(")")
+
     def compile_if(self, node):
         self.current_object.write_source("if (")
         self.compile_expression(node.children[0])
@@ -1523,7 +4100,98 @@ class Compiler:
         self.current_object.write_source("else ")
         self.compile_if(node.children[0])
 
+    def compile_simd_loop(self, node):
+        alignment, loop = node.children
+
+        # the loops pass may have wrapped the loop in a block with its hoisted temporaries
+        inner = loop
+        while inner.data == "loop_block":
+            inner = inner.children[-1]
+
+        # gcc takes one of the two, omp simd also vectorizes reductions but only fits canonical for loops
+        pragma = "GCC ivdep"
+        reductions = self.get_simd_reductions(inner) if inner.data == "for_statement" else None
+        if reductions != None:
+            pragma = "omp simd" + "".join(" reduction(%s:%s)" % (operator, name) for name, operator in reductions.items())
+
+        if alignment != None:
+            written = set()
+            for write in inner.iter_subtrees():
+                if write.data in LOOP_WRITES and isinstance(write.children[0], lark.Tree) and write.children[0].data == "var":
+                    written.add(str(write.children[0].children[0]))
+
+            symbols = self.current_function.symbols if self.current_function != None else {}
+            bases = []
+            for deref in inner.find_data("deref_var"):
+                base = str(deref.children[1])
+                if symbols.get(base, "").endswith("*") and not base in written and not base in bases:
+                    bases.append(base)
+
+            for base in bases:
+                self.current_object.write_source("%s = __builtin_assume_aligned(%s, %s);\n    " % (base, base, alignment))
+
+        self.loop_pragma = (inner, pragma)
+        self.compile_statement(loop)
+        self.loop_pragma = None
+
+    def get_simd_reductions(self, node):
+        # omp simd only takes canonical loops, `i = a; i < b; i++` with no way out of the body,
+        # and every outside scalar the body writes has to be a `+=` or `*=` reduction
+        init, condition, step = node.children[0:3]
+        if init == None or step == None or node.children[-1] != None:
+            return None
+
+        init = init.children[0]
+        if init.data != "assign" or init.children[0].data != "var":
+            return None
+        index = str(init.children[0].children[0])
+
+        condition = condition.children[0]
+        if not condition.data in ("logic_lt", "logic_le", "logic_gt", "logic_ge", "logic_notequals"):
+            return None
+        if not any(isinstance(side, lark.Tree) and side.data == "var" and str(side.children[0]) == index for side in condition.children):
+            return None
+
+        step = step.children[0]
+        if not step.data in ("post_inc", "pre_inc", "post_dec", "pre_dec", "plus_eq", "minus_eq"):
+            return None
+        if step.children[0].data != "var" or str(step.children[0].children[0]) != index:
+            return None
+
+        body = [statement for statement in node.children[3:-1] if isinstance(statement, lark.Tree)]
+        declared = set(str(sub.children[1]) for statement in body for sub in statement.find_data("stack_allocation"))
+        reductions = {}
+        uses = {}
+        for statement in body:
+            for sub in statement.iter_subtrees():
+                if sub.data in ("break", "return_statement", "tail_call", "raw_c_statement", "inline_call", "try_statement"):
+                    return None
+                if sub.data == "var":
+                    uses[str(sub.children[0])] = uses.get(str(sub.children[0]), 0) + 1
+                if not sub.data in LOOP_WRITES or not isinstance(sub.children[0], lark.Tree) or sub.children[0].data != "var":
+                    continue
+
+                name = str(sub.children[0].children[0])
+                if name in declared:
+                    continue
+                operator = { "plus_eq": "+", "mul_eq": "*" }.get(sub.data)
+                if name == index or operator == None or reductions.get(name, operator) != operator:
+                    return None
+                reductions[name] = operator
+                uses[name] = uses.get(name, 0) - 1
+
+        # a reduction variable may not be read anywhere else in the body
+        if any(uses.get(name, 0) != 0 for name in reductions):
+            return None
+        return reductions
+
+    def write_loop_pragma(self, node):
+        if self.loop_pragma == None or not self.loop_pragma[0] is node:
+            return
+        self.current_object.write_source("\n#pragma %s\n    " % self.loop_pragma[1])
+
     def compile_while(self, node):
+        self.write_loop_pragma(node)
         self.current_object.write_source("while (")
         self.compile_expression(node.children[0])
         self.current_object.write_source("){\n")
@@ -1576,6 +4244,7 @@ class Compiler:
         else:
             self.break_labels.append(None)
 
+        self.write_loop_pragma(node)
         self.current_object.write_source("for(")
         if node.children[0] != None:
             self.compile_expression(node.children[0])
@@ -1600,6 +4269,27 @@ class Compiler:
                 self.compile_statement(child)
             self.current_object.write_source("for_%s_end:\n" % myself)
 
+    def compile_loop_block(self, node):
+        # a loop with the temporaries the loops pass hoisted out of it
+        self.current_object.write_source("{\n")
+        for child in node.children:
+            self.compile_statement(child)
+        self.current_object.write_source("    }\n")
+
+    def compile_loop_temp(self, node):
+        c_type, name, value = node.children
+        self.current_object.write_source("%s %s" % (c_type, name))
+        if value != None:
+            self.current_object.write_source(" = ")
+            self.compile_expression(value)
+        self.current_object.write_source(";\n")
+
+    def compile_comma(self, node):
+        for i in range(len(node.children)):
+            if i > 0:
+                self.current_object.write_source(", ")
+            self.compile_expression(node.children[i])
+
     def compile_break(self):
         if len(self.break_labels) == 0 or self.break_labels[-1] == None:
             self.current_object.write_source("break;\n")
@@ -1610,11 +4300,55 @@ class Compiler:
         self.current_object.write_source("continue;\n")
     
 
-with open("./data/grammar.lark", "r") as f:
-    Grammar = f.read()
+GRAMMAR_FILE = os.path.join(COMPILER_DIR, "data", "grammar.lark")
+GRAMMAR_CACHE_FILE = os.path.join(COMPILER_DIR, "data", "grammar.lark.cache")
+
+Grammar = None
+GrammarHash = None
+Parser = None
 
 errors = 0
 current_file = ""
+
+def load_grammar():
+    global Grammar
+    if Grammar == None:
+        with open(GRAMMAR_FILE, "r") as f:
+            Grammar = f.read()
+    return Grammar
+
+def get_grammar_hash():
+    global GrammarHash
+    if GrammarHash == None:
+        GrammarHash = hashlib.sha256(load_grammar().encode("utf-8")).hexdigest()
+    return GrammarHash
+
+def load_parser():
+    global Parser
+    if Parser == None:
+        # lark stores the LALR tables in the cache file together with a hash of the
+        # grammar and options, and rebuilds them itself when that hash changes.
+        # Without write access next to the grammar it falls back to the temp dir.
+        cache = GRAMMAR_CACHE_FILE if os.access(os.path.dirname(GRAMMAR_CACHE_FILE), os.W_OK) else True
+        Parser = Lark(load_grammar(), parser="lalr", maybe_placeholders=True, propagate_positions=True, cache=cache)
+    return Parser
+
+def parse_code(code):
+    global Parser, CurrentProject
+    cache = CurrentProject.build_cache if CurrentProject != None else None
+
+    if cache != None:
+        tree = cache.load_tree(current_file, code)
+        if tree != None:
+            return tree
+
+    with Timings.phase("parse"):
+        tree = Parser.parse(code, on_error=parser_error)
+
+    if cache != None and errors == 0:
+        cache.store_tree(current_file, code, tree)
+    return tree
+
 def parser_error(e):
     global errors, current_file
 
@@ -1630,9 +4364,56 @@ def print_help():
     print("cal --help - prints help")
     print("cal init [name] { flags } -> initializes project")
     print("cal build [name] { flags } -> builds project")
+    print("cal run [name] { flags } -> builds and runs project")
+    print("cal check [name] { flags } -> generates the C sources without invoking gcc")
+    print("cal serve [name] -> starts a compile server keeping parsed modules warm,")
+    print("                    build/run/check use it while it is running")
+    print("cal stop [name] -> stops the compile server")
+    print("cal bench { flags } -> times the compiler's phases and gcc on synthetic programs")
+    print("                       and the bundled .cal files, --runtime times the programs in")
+    print("                       benchmarks/ instead, see benchmark.py for its flags")
     print("flags:")
     print("    -k  keep intermediate (.c/.h) files")
-    print("    -r  compile in release mode (optimizations)")
+    print("    -r1 -r2  compile with the optimized-debug (-g -O1) or release (-O2) profile")
+    print("    --profile NAME  compile with a build profile (debug, optimized-debug, release, fast")
+    print("                    or one defined under [profile.NAME] in the project's cal.toml)")
+    print("    -j N  run up to N gcc jobs at the same time (defaults to the cpu count)")
+    print("    -f  force a full rebuild, ignoring the build cache in bin/.calcache")
+    print("    --unity  compile every object as a single translation unit (at least -O2)")
+    print("    --passes a,b  IR passes to run instead of the optimization level's pipeline")
+    print("                  (or [build] passes in cal.toml), --passes \"\" runs none")
+    print("    --dump-ir  write the IR of every object after the passes to bin/<object>.ir")
+    print("    --no-dce  keep functions and libs the proc's main never reaches")
+    print("    --result-abi struct|outparam  return $result values as a struct, or as the error")
+    print("                                  code with the ok value written through a pointer")
+    print("                                  (or [build] result_abi in cal.toml)")
+    print("    --defer-lowering copy|cleanup  copy a fn's defers in front of every return, or")
+    print("                                   write them once in a cleanup chain at its end")
+    print("                                   (or [build] defer_lowering in cal.toml)")
+    print("    a lib's glob fns are exported through wrappers unless the lib says $export MODE;")
+    print("    (direct, alias or inline) or cal.toml sets it under [export] (LIBNAME = or default =)")
+    print("    --pgo  profile guided build, runs the binary with the --train \"ARGS\" arguments")
+    print("           (or [pgo] train in cal.toml) and rebuilds with the recorded profile")
+
+def get_flag_value(flags, flag, default=None):
+    # either "flag value" or "flag=value", a longer flag that only starts the same is a different flag
+    for i in range(len(flags)):
+        if flags[i] == flag and i + 1 < len(flags):
+            return flags[i + 1]
+        if flags[i].startswith(flag + "="):
+            return flags[i][len(flag) + 1:]
+    return default
+
+def get_job_count(flags):
+    jobs = get_flag_value(flags, "-j", None)
+    if jobs == None:
+        return os.cpu_count() or 1
+
+    try:
+        return max(1, int(jobs))
+    except ValueError:
+        print("Invalid job count '%s', building with 1 job" % jobs)
+        return 1
 
 def update_project(name):
     import shutil
@@ -1650,6 +4431,18 @@ def init_project(name):
     
     #update_project(name)
 
+    with open("./projects/%s/cal.toml" % name, "w") as f:
+        f.write("[build]\n")
+        f.write("profile = \"debug\"\n")
+        f.write("# result_abi = \"outparam\"\n")
+        f.write("# defer_lowering = \"copy\"\n\n")
+        f.write("# [profile.fast]\n")
+        f.write("# cflags = [\"-O3\", \"-flto\", \"-march=native\", \"-fno-plt\", \"-ffunction-sections\", \"-fdata-sections\"]\n")
+        f.write("# ldflags = [\"-flto\", \"-Wl,--gc-sections\"]\n\n")
+        f.write("# [export]\n")
+        f.write("# default = \"direct\"\n")
+        f.write("# stdmem = \"inline\"\n")
+
     with open("./projects/%s/src/core.cal" % name, "w") as f:
         f.write("lib core {\n")
         f.write("    link stdio;\n\n")
@@ -1669,10 +4462,314 @@ def init_project(name):
         f.write("}\n")
 
 
-def main():
-    global Grammar, CurrentProject, errors, current_file, Parser
+def build_objects(objects, flags, cache, overrides=None):
+    if "--unity" in flags:
+        return build_unity(objects, cache, overrides)
+
+    scheduler = BuildScheduler(get_job_count(flags), cache, overrides)
+    return scheduler.build(objects)
+
+def run_training(name, train_args, runs=1):
+    command = "%s %s" % (get_executable(name), train_args)
+    best = None
+
+    for i in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(command, shell=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+
+        if result.returncode != 0:
+            print("Training command '%s' exited with status %s" % (command, result.returncode))
+
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+"""
+    A --pgo build compiles the objects three times: a plain -O2 build that
+    is timed on the training command as the baseline, an instrumented
+    build (-fprofile-generate) that records the .gcda files in bin/pgo/
+    while running the training command, and the final build that uses them
+    (-fprofile-use). The build cache is bypassed, the .gcda files are not
+    part of any gcc command it could fingerprint.
+"""
+def build_pgo(objects, name, flags, profile, config):
+    global CurrentProject
+    pgo_config = config.get("pgo", {})
+    train_args = get_flag_value(flags, "--train", pgo_config.get("train", ""))
+    runs = max(1, int(get_flag_value(flags, "--train-runs", pgo_config.get("runs", 1))))
+
+    pgo_dir = os.path.abspath(os.path.join(CurrentProject.output_dir, "pgo"))
+    os.makedirs(pgo_dir, exist_ok=True)
+
+    if profile["name"] == "debug":
+        profile = get_profile("release", config)
+
+    # every step goes through the cache, the -fprofile-* flags are part of the
+    # gcc command the object keys hash, so the manifest always names the build
+    # left in bin/ and the next plain build replaces it
+    cache = CurrentProject.build_cache
+
+    print("PGO: building the plain -O2 baseline")
+    if not build_objects(objects, flags, cache, { "profile": get_profile("release", config) }):
+        return False
+    baseline_time = run_training(name, train_args, runs)
+
+    for file in os.listdir(pgo_dir):
+        if file.endswith(".gcda"):
+            os.remove(os.path.join(pgo_dir, file))
+
+    generate = dict(profile)
+    generate["cflags"] = profile["cflags"] + [ "-fprofile-generate=%s" % pgo_dir ]
+    generate["ldflags"] = profile["ldflags"] + [ "-fprofile-generate=%s" % pgo_dir ]
+
+    print("PGO: building the instrumented binary")
+    if not build_objects(objects, flags, cache, { "profile": generate }):
+        return False
+
+    print("PGO: running the training command")
+    run_training(name, train_args)
+
+    use = dict(profile)
+    use["cflags"] = profile["cflags"] + [ "-fprofile-use=%s" % pgo_dir, "-fprofile-correction", "-Wno-missing-profile" ]
+    use["ldflags"] = profile["ldflags"] + [ "-fprofile-use=%s" % pgo_dir ]
+
+    print("PGO: building with the recorded profile")
+    if not build_objects(objects, flags, cache, { "profile": use }):
+        return False
+    pgo_time = run_training(name, train_args, runs)
+
+    print("PGO: training run took %.3f s with -O2 and %.3f s with %s + PGO (%.2fx)" % (baseline_time, pgo_time, profile["name"], baseline_time / max(pgo_time, 1e-9)))
+    return True
+
+
+def build_project(command, name, flags):
+    global CurrentProject, errors, current_file
     code = ""
+    errors = 0
+    current_file = ""
+    Modules.reset_stats()
+    Modules.reset_dead_code()
+
+    CurrentProject = ProjectInfo(name, "./projects/%s/" % name)
+    config = load_project_config(CurrentProject)
+
+    profile_name = config.get("build", {}).get("profile", "debug")
+
+    if "-r1" in flags:
+        profile_name = "optimized-debug"
+    elif "-r2" in flags:
+        profile_name = "release"
+
+    profile_name = get_flag_value(flags, "--profile", profile_name)
+
+    if "--unity" in flags and profile_name == "debug":
+        # whole program optimization is the point of a unity build
+        print("Unity build, compiling with the release profile")
+        profile_name = "release"
+
+    profile = get_profile(profile_name, config)
+    optimizations = get_profile_optimization(profile)
+    passes = get_pass_names(flags, config, optimizations)
+    result_abi = get_flag_value(flags, "--result-abi", config.get("build", {}).get("result_abi", "struct"))
+
+    if not result_abi in RESULT_ABIS:
+        print("Unknown result abi %s, expected one of %s" % (result_abi, ", ".join(RESULT_ABIS)))
+        return False
+    defer_lowering = get_flag_value(flags, "--defer-lowering", config.get("build", {}).get("defer_lowering", "cleanup"))
+
+    if not defer_lowering in DEFER_LOWERINGS:
+        print("Unknown defer lowering %s, expected one of %s" % (defer_lowering, ", ".join(DEFER_LOWERINGS)))
+        return False
+    print("Build profile: %s (%s)" % (profile_name, " ".join(profile["cflags"] + profile["ldflags"])))
+    print("IR passes: %s" % (", ".join(passes) if len(passes) > 0 else "none"))
+    print("Result abi: %s" % result_abi)
+
+    CurrentProject.build_cache = BuildCache(CurrentProject.output_dir, str(optimizations), force="-f" in flags)
+    file = CurrentProject.get_main_file()
+    
+    if file == "":
+        print("Project main file not found. Searched names were '%s.cal' and 'main.cal' in '%s'" % (CurrentProject.name, CurrentProject.search_paths[0]))
+        return False
+
+    load_parser()
+
+    start = time.perf_counter()
+
+    with open(file, "r") as f:
+        code = f.read()
+    current_file = file
+    parsed = parse_code(code)
+
+    if errors != 0:
+        print("Compilation aborted due to %s unresolved errors" % errors)
+        return False
+
+    compiler = Compiler()
+    compiler.compile(parsed, keep_source="-k" in flags, optimization=optimizations, profile=profile, passes=passes, dump_ir="--dump-ir" in flags, export_modes=config.get("export", {}), result_abi=result_abi, defer_lowering=defer_lowering)
+
+    print("Generated C in %.1f ms" % ((time.perf_counter() - start) * 1000))
+    print("Module registry: parsed %s linked modules, avoided %s re-parses" % (Modules.parses, Modules.avoided_parses))
+
+    if command == "check":
+        return True
+
+    eliminate_dead_code(compiler.objects, not "--no-dce" in flags)
+    objects = [obj for obj in compiler.objects if not obj.dead]
+    for obj in compiler.objects:
+        if obj.dead:
+            # nothing is compiled from it, but the proc still includes its header
+            obj.write_files()
+
+    if "--pgo" in flags:
+        build_ok = build_pgo(objects, name, flags, profile, config)
+    else:
+        build_ok = build_objects(objects, flags, CurrentProject.build_cache)
+
+    if CurrentProject.build_cache != None:
+        cache = CurrentProject.build_cache
+        print("Build cache: reused %s parse trees and %s objects" % (cache.reused_trees, cache.reused_objects))
+
+    if not ("-k" in flags):
+        for object in compiler.objects:
+            header = os.path.join(CurrentProject.output_dir, object.target_header_name)
+            source = os.path.join(CurrentProject.output_dir, object.target_source_name)
+            unity_source = os.path.join(CurrentProject.output_dir, object.target_unity_name)
+
+            if object.target_type == ObjectType.Process and os.path.exists(unity_source):
+                os.remove(unity_source)
+
+            if os.path.exists(source):
+                os.remove(source)
+            if os.path.exists(header):
+                os.remove(header)
+    else:
+        print("Keeping compiled source files in bin directory")
+
+    if not build_ok:
+        print("Build failed")
+
+    return build_ok
+
+def get_executable(name):
+    return os.path.join("./projects/%s/bin/" % name, name)
+
+def get_server_socket(name):
+    return os.path.join("./projects/%s/bin/" % name, ".calserve.sock")
+
+def send_server_request(name, request):
+    socket_path = get_server_socket(name)
+    if not os.path.exists(socket_path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+
+        data = b""
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except OSError:
+        # nobody is listening anymore, the server did not get to clean up after itself
+        os.remove(socket_path)
+        return None
+    finally:
+        client.close()
+
+    return json.loads(data.decode("utf-8"))
+
+"""
+    The compile server keeps one python process alive per project so the
+    lark parser and every linked module in the ModuleRegistry stay warm
+    between builds. Requests come in over a unix socket in the project's
+    bin/ directory, build/run/check use it automatically while it runs.
+    Before each request the modification times of the registered modules
+    (and the search path directories, to notice new or removed files) are
+    checked, and only the modules that changed and the modules linking
+    them are thrown away.
+"""
+def handle_server_request(name, request):
+    command = request.get("command", "build")
+    flags = request.get("flags", [])
+
+    output = io.StringIO()
+    ok = False
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(output):
+        try:
+            invalidated = Modules.invalidate_stale(ProjectInfo(name, "./projects/%s/" % name).search_paths)
+            if invalidated > 0:
+                print("Server: %s modules changed since the last build" % invalidated)
+
+            ok = build_project("build" if command == "run" else command, name, flags)
+        except Exception:
+            traceback.print_exc(file=output)
+            ok = False
+
+        print("Server: request finished in %.1f ms" % ((time.perf_counter() - start) * 1000))
 
+    return { "ok": ok, "output": output.getvalue() }
+
+def serve_project(name, flags):
+    socket_path = get_server_socket(name)
+
+    if send_server_request(name, { "command": "ping" }) != None:
+        print("A compile server is already running for %s" % name)
+        return
+
+    if not os.path.exists(os.path.dirname(socket_path)):
+        print("Project %s not found" % name)
+        return
+
+    load_parser()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print("Serving %s on %s (stop with 'cal stop %s')" % (name, socket_path, name))
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+
+                try:
+                    request = json.loads(data.decode("utf-8"))
+                except ValueError:
+                    continue
+
+                command = request.get("command")
+                if command == "ping":
+                    response = { "ok": True, "output": "" }
+                elif command == "stop":
+                    connection.sendall(json.dumps({ "ok": True, "output": "Compile server stopped\n" }).encode("utf-8"))
+                    break
+                else:
+                    response = handle_server_request(name, request)
+                    print("%s %s: %s" % (command, " ".join(request.get("flags", [])), "ok" if response["ok"] else "failed"))
+
+                connection.sendall(json.dumps(response).encode("utf-8"))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def main():
     #print("overwriting args")
     #_t = sys.argv[0]
     #sys.argv = [_t, "build", "hello_world", "-k", "-r2"]
@@ -1680,13 +4777,18 @@ def main():
     if not os.path.exists("./projects"):
         os.mkdir("projects")
 
-    file = ""
     if len(sys.argv) <= 1 or sys.argv[1] == "help":
         print_help()
         return
 
     command = sys.argv[1]
 
+    if command == "bench":
+        import benchmark
+        if not benchmark.run_benchmarks(sys.argv[2:]):
+            sys.exit(1)
+        return
+
     if len(sys.argv) < 3:
         print("Please provide a project name")
         return
@@ -1698,7 +4800,7 @@ def main():
     for i in range(3, len(sys.argv)):
         flags.append(sys.argv[i])
 
-    if not command in [ "build", "run", "init", "update" ]:
+    if not command in [ "build", "run", "check", "init", "update", "serve", "stop" ]:
         print("Unknown command %s" % command)
         return
     
@@ -1709,50 +4811,28 @@ def main():
     if command == "update":
         update_project(name)
         return
-    
-    optimizations = OptimizationLevel.Debug
-
-    if "-r1" in flags:
-        optimizations = OptimizationLevel.LowOptimization
-    elif "-r2" in flags:
-        optimizations = OptimizationLevel.HighOptimization
 
-    CurrentProject = ProjectInfo(name, "./projects/%s/" % name)
-    file = CurrentProject.get_main_file()
-    
-    if file == "":
-        print("Project main file not found. Searched names were '%s.cal' and 'main.cal' in '%s'" % (CurrentProject.name, CurrentProject.search_paths[0]))
+    if command == "serve":
+        serve_project(name, flags)
         return
 
-    Parser = Lark(Grammar, parser="lalr", maybe_placeholders=True, propagate_positions=True)
-
-    with open(file, "r") as f:
-        code = f.read()
-    current_file = file
-    parsed = Parser.parse(code, on_error=parser_error)
-
-    if errors == 0:
-        compiler = Compiler()
-        compiler.compile(parsed, keep_source="-k" in flags, optimization=optimizations)
-
-        if not ("-k" in flags):
-            for object in compiler.objects:
-                header = os.path.join(CurrentProject.output_dir, object.target_header_name)
-                source = os.path.join(CurrentProject.output_dir, object.target_source_name)
-
-                if os.path.exists(source):
-                    os.remove(source)
-                if os.path.exists(header):
-                    os.remove(header)
+    if command == "stop":
+        if send_server_request(name, { "command": "stop" }) == None:
+            print("No compile server is running for %s" % name)
         else:
-            print("Keeping compiled source files in bin directory")
+            print("Compile server stopped")
+        return
 
-        if command == "run":
-            cmd = os.path.join(CurrentProject.output_dir, CurrentProject.name)
-            print("Running Executable\n")
-            os.system(cmd)
+    response = send_server_request(name, { "command": command, "flags": flags })
+    if response != None:
+        print(response["output"], end="")
+        build_ok = response["ok"]
     else:
-        print("Compilation aborted due to %s unresolved errors" % errors)
+        build_ok = build_project(command, name, flags)
+
+    if build_ok and command == "run":
+        print("Running Executable\n")
+        os.system(get_executable(name))
 
 
 if __name__ == "__main__":